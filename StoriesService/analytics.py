@@ -0,0 +1,374 @@
+# encoding: utf8
+import datetime
+import hashlib
+import json
+import math
+import sys
+from array import array
+from collections import Counter, defaultdict
+from itertools import combinations
+
+import click
+from flask.cli import with_appcontext
+
+from StoriesService.database import db, Story, ArchivedStory, FigureSketch
+
+# Count-Min: estimates exceed the true count by at most e / CMS_WIDTH * (total of the counts),
+# except with probability e ** -CMS_DEPTH. Each family of keys has its own sketch, sized for its total:
+# pairs are counted ~2.5 times as often as figures, and a day only holds the figures of its stories
+CMS_WIDTH = 2048
+CMS_DEPTH = 5
+PAIR_CMS_WIDTH = 8192
+PAIR_CMS_DEPTH = 4
+DAY_CMS_WIDTH = 512
+DAY_CMS_DEPTH = 4
+# HyperLogLog: 2 ** HLL_PRECISION registers of one byte, standard error 1.04 / sqrt(2 ** HLL_PRECISION)
+HLL_PRECISION = 10
+# Candidates kept by the heavy hitters lists
+TOP_CAPACITY = 64
+
+FIGURE_COUNTS = 'counts:figures'
+PAIR_COUNTS = 'counts:pairs'
+DAY_COUNTS = 'counts:day:'
+TOP_FIGURES = 'top:figures'
+TOP_PAIRS = 'top:pairs'
+AUTHORS = 'authors:'
+
+
+def _hash(value, size=8):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf8'), digest_size=size).digest(), 'little')
+
+
+# Faces of the dice rolled for a story, '#cat#dog#' -> ['cat', 'dog']
+def split_figures(figures):
+    return [figure for figure in (figures or '').split('#') if figure]
+
+
+def _day(date):
+    return date.strftime('%Y-%m-%d')
+
+
+# Keys counted for a story: each figure (overall and in the day of the story) and each pair of figures.
+# The exact statistics use them, the sketches count each family of keys separately
+def story_keys(figures, date):
+    keys = []
+    for figure in figures:
+        keys.append('figure:' + figure)
+        keys.append('day:%s:%s' % (figure, _day(date)))
+    keys += ['pair:%s#%s' % pair for pair in combinations(sorted(set(figures)), 2)]
+    return keys
+
+
+class CountMinSketch:
+
+    def __init__(self, width=CMS_WIDTH, depth=CMS_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self.counters = array('I', bytes(4 * width * depth))
+
+    def _cells(self, key):
+        h = _hash(key, 16)
+        h1, h2 = h & 0xFFFFFFFFFFFFFFFF, (h >> 64) | 1
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    # Returns the new estimate of the key
+    def add(self, key, count=1):
+        counters = self.counters
+        estimate = None
+        for cell in self._cells(key):
+            counters[cell] += count
+            if estimate is None or counters[cell] < estimate:
+                estimate = counters[cell]
+        self.total += count
+        return estimate
+
+    def estimate(self, key):
+        return min(self.counters[cell] for cell in self._cells(key))
+
+    # Maximum overestimate (with probability 1 - e ** -depth)
+    def error_bound(self):
+        return math.e / self.width * self.total
+
+    def to_bytes(self):
+        counters = array('I', self.counters)
+        if sys.byteorder == 'big':
+            counters.byteswap()
+        header = json.dumps({'width': self.width, 'depth': self.depth, 'total': self.total}).encode('utf8')
+        return len(header).to_bytes(4, 'little') + header + counters.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        size = int.from_bytes(data[:4], 'little')
+        header = json.loads(data[4:4 + size].decode('utf8'))
+        sketch = cls(header['width'], header['depth'])
+        sketch.total = header['total']
+        sketch.counters = array('I', data[4 + size:])
+        if sys.byteorder == 'big':
+            sketch.counters.byteswap()
+        return sketch
+
+
+class HyperLogLog:
+
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(1 << precision)
+
+    def add(self, value):
+        h = _hash(str(value))
+        bits = 64 - self.precision
+        index, rest = h >> bits, h & ((1 << bits) - 1)
+        rank = bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        # Small cardinalities: linear counting
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(len(data).bit_length() - 1, data)
+
+
+# Heavy hitters: the TOP_CAPACITY keys with the highest estimated count seen so far
+class TopK:
+
+    def __init__(self, capacity=TOP_CAPACITY, items=None):
+        self.capacity = capacity
+        self.items = dict(items or {})
+
+    def offer(self, key, estimate):
+        if key not in self.items and len(self.items) >= self.capacity:
+            smallest = min(self.items, key=self.items.get)
+            if estimate <= self.items[smallest]:
+                return
+            del self.items[smallest]
+        self.items[key] = estimate
+
+    def top(self, k):
+        return sorted(self.items.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+    def to_bytes(self):
+        return json.dumps({'capacity': self.capacity, 'items': self.items}).encode('utf8')
+
+    @classmethod
+    def from_bytes(cls, data):
+        loaded = json.loads(data.decode('utf8'))
+        return cls(loaded['capacity'], loaded['items'])
+
+
+SKETCHES = {
+    FIGURE_COUNTS: CountMinSketch,
+    PAIR_COUNTS: CountMinSketch,
+    TOP_FIGURES: TopK,
+    TOP_PAIRS: TopK,
+}
+
+
+# The authors of each figure and the counts of each day are sketches of their own
+def _sketch_class(name):
+    if name.startswith(AUTHORS):
+        return HyperLogLog
+    if name.startswith(DAY_COUNTS):
+        return CountMinSketch
+    return SKETCHES[name]
+
+
+def _new_sketch(name):
+    if name == PAIR_COUNTS:
+        return CountMinSketch(PAIR_CMS_WIDTH, PAIR_CMS_DEPTH)
+    if name.startswith(DAY_COUNTS):
+        return CountMinSketch(DAY_CMS_WIDTH, DAY_CMS_DEPTH)
+    return _sketch_class(name)()
+
+
+# The sketches of the figures of the published stories, loaded from (and saved to) the figure_sketch table.
+# Only the rows that are needed are read: the memory used does not depend on the number of stories
+class FigureSketches:
+
+    def __init__(self):
+        self.sketches = {}
+        self._rows = {}
+
+    # Loads the given sketches, the missing ones are empty. With for_update, the figure counts row is locked
+    # (the whole database on SQLite, which ignores FOR UPDATE): the updates of concurrent publications are serialized
+    def load(self, names, for_update=False):
+        names = [name for name in names if name not in self.sketches]
+        if for_update and FIGURE_COUNTS in names:
+            connection = db.session.connection()
+            if connection.dialect.name == 'sqlite' and not connection.connection.in_transaction:
+                connection.execute('BEGIN IMMEDIATE')
+            row = FigureSketch.query.filter(FigureSketch.name == FIGURE_COUNTS).with_for_update().one_or_none()
+            self._keep(FIGURE_COUNTS, row)
+            names.remove(FIGURE_COUNTS)
+        if names:
+            rows = {row.name: row for row in FigureSketch.query.filter(FigureSketch.name.in_(names))}
+            for name in names:
+                self._keep(name, rows.get(name))
+        return self
+
+    def _keep(self, name, row):
+        self._rows[name] = row
+        self.sketches[name] = _sketch_class(name).from_bytes(row.data) if row is not None else _new_sketch(name)
+
+    def __getitem__(self, name):
+        return self.sketches[name]
+
+    def authors(self, figure):
+        return self.sketches[AUTHORS + figure]
+
+    def day(self, date):
+        return self.sketches[DAY_COUNTS + _day(date)]
+
+    def record(self, figures, author_id, date):
+        counts, day = self[FIGURE_COUNTS], self.day(date)
+        estimates = {}
+        for figure in figures:
+            estimates[figure] = counts.add(figure)
+            day.add(figure)
+        for figure in set(figures):
+            self[TOP_FIGURES].offer(figure, estimates[figure])
+            self.authors(figure).add(author_id)
+        for pair in combinations(sorted(set(figures)), 2):
+            pair = '%s#%s' % pair
+            self[TOP_PAIRS].offer(pair, self[PAIR_COUNTS].add(pair))
+
+    def save(self):
+        for name, sketch in self.sketches.items():
+            row = self._rows.get(name)
+            if row is None:
+                row = self._rows[name] = FigureSketch(name=name)
+                db.session.add(row)
+            row.data = sketch.to_bytes()
+
+
+# Adds a published story to the sketches (the caller commits)
+def record_story(story):
+    figures = split_figures(story.figures)
+    sketches = FigureSketches().load([FIGURE_COUNTS], for_update=True)
+    sketches.load([PAIR_COUNTS, DAY_COUNTS + _day(story.date), TOP_FIGURES, TOP_PAIRS] +
+                  [AUTHORS + figure for figure in set(figures)])
+    sketches.record(figures, story.author_id, story.date)
+    sketches.save()
+
+
+def _bound(sketch):
+    return int(math.ceil(sketch.error_bound()))
+
+
+# Estimated count of the pair, 0 if it is not above the error bound (it could be only collisions)
+def _pair_count(pairs, pair):
+    count = pairs.estimate(pair)
+    return count if count > pairs.error_bound() else 0
+
+
+# Most used figures (estimated count and number of distinct authors) and most frequent pairs of figures
+def figures_summary(k):
+    sketches = FigureSketches().load([FIGURE_COUNTS, PAIR_COUNTS, TOP_FIGURES, TOP_PAIRS])
+    top = [figure for figure, _ in sketches[TOP_FIGURES].top(k)]
+    sketches.load([AUTHORS + figure for figure in top])
+    counts, pairs = sketches[FIGURE_COUNTS], sketches[PAIR_COUNTS]
+    figures = [{'figure': figure, 'count': counts.estimate(figure),
+                'authors': sketches.authors(figure).count()} for figure in top]
+    together = [{'figures': pair.split('#'), 'count': _pair_count(pairs, pair)}
+                for pair, _ in sketches[TOP_PAIRS].top(k)]
+    return {
+        'figures': sorted(figures, key=lambda item: (-item['count'], item['figure'])),
+        'pairs': sorted([item for item in together if item['count']],
+                        key=lambda item: (-item['count'], item['figures'])),
+        'error_bound': _bound(counts),
+        'pairs_error_bound': _bound(pairs),
+    }
+
+
+# Statistics of a figure: estimated count and authors, count of each day between the two dates
+# (with the largest error bound of these days), and the heavy hitters it is most rolled with
+def figure_details(figure, begin_date, end_date, k):
+    dates = [begin_date + datetime.timedelta(days=n) for n in range((end_date - begin_date).days + 1)]
+    sketches = FigureSketches().load([FIGURE_COUNTS, PAIR_COUNTS, TOP_FIGURES, AUTHORS + figure] +
+                                     [DAY_COUNTS + _day(date) for date in dates])
+    pairs = sketches[PAIR_COUNTS]
+    days = {}
+    for date in dates:
+        count = sketches.day(date).estimate(figure)
+        if count:
+            days[_day(date)] = count
+    together = []
+    for other in sketches[TOP_FIGURES].items:
+        if other != figure:
+            count = _pair_count(pairs, '%s#%s' % tuple(sorted((figure, other))))
+            if count:
+                together.append({'figure': other, 'count': count})
+    return {
+        'figure': figure,
+        'count': sketches[FIGURE_COUNTS].estimate(figure),
+        'authors': sketches.authors(figure).count(),
+        'days': days,
+        'with': sorted(together, key=lambda item: (-item['count'], item['figure']))[:k],
+        'error_bound': _bound(sketches[FIGURE_COUNTS]),
+        'days_error_bound': max(_bound(sketches.day(date)) for date in dates),
+        'with_error_bound': _bound(pairs),
+    }
+
+
+# Figures, author and date of every published story, archived ones included
+def _published(batch_size=1000):
+    yield from db.session.query(Story.figures, Story.author_id, Story.date) \
+        .filter(Story.is_draft == False).yield_per(batch_size)
+    yield from db.session.query(ArchivedStory.figures, ArchivedStory.author_id, ArchivedStory.date) \
+        .yield_per(batch_size)
+
+
+# Exact counts of the keys and sets of authors of each figure, computed with a scan of the stories.
+# Memory grows with the data: meant for validation
+def exact_statistics():
+    counts, authors = Counter(), defaultdict(set)
+    for figures, author_id, date in _published():
+        figures = split_figures(figures)
+        counts.update(story_keys(figures, date))
+        for figure in figures:
+            authors[figure].add(author_id)
+    return counts, authors
+
+
+# Rebuilds the sketches from the stories, e.g. to forget deleted stories (the sketches only grow)
+def rebuild_sketches():
+    FigureSketch.query.delete()
+    sketches = FigureSketches()
+    for name in SKETCHES:
+        sketches.sketches[name] = _new_sketch(name)
+    for figures, author_id, date in _published():
+        figures = split_figures(figures)
+        for name in [AUTHORS + figure for figure in set(figures)] + [DAY_COUNTS + _day(date)]:
+            if name not in sketches.sketches:
+                sketches.sketches[name] = _new_sketch(name)
+        sketches.record(figures, author_id, date)
+    sketches.save()
+    db.session.commit()
+
+
+@click.command('figures')
+@with_appcontext
+@click.option('--rebuild', is_flag=True, help='Rebuild the sketches from the stories first')
+@click.option('--top', type=int, default=10, help='Number of figures to compare')
+def figures_command(rebuild, top):
+    """Compare the figure sketches with the exact statistics."""
+    if rebuild:
+        rebuild_sketches()
+    summary = figures_summary(top)
+    counts, authors = exact_statistics()
+    click.echo('%-20s %10s %10s %10s %10s' % ('figure', 'count', 'exact', 'authors', 'exact'))
+    for item in summary['figures']:
+        click.echo('%-20s %10d %10d %10d %10d' % (item['figure'], item['count'], counts['figure:' + item['figure']],
+                                                  item['authors'], len(authors[item['figure']])))
+    click.echo('Count error bound: %d' % summary['error_bound'])
@@ -1,28 +1,84 @@
 import datetime
+import os
 
 from flask import Flask
 
+from StoriesService.analytics import figures_command
+from StoriesService.archive import archive_command
+from StoriesService.corpus import export_command, import_command
 from StoriesService.database import db, Story
-from StoriesService.urls import DEFAULT_DB
+from StoriesService.feed import FeedSnapshots
+from StoriesService.limits import Limiter
+from StoriesService.profiling import Profiling, profile_token_command, default_directory
+from StoriesService.repository import init_app as init_repository
+from StoriesService.schema import upgrade_schema
+from StoriesService.tasks import celery, init_app as init_celery
+from StoriesService.urls import DEFAULT_DB, DEFAULT_BROKER
 from StoriesService.views import blueprints
 
 
-def create_app(database=DEFAULT_DB, wtf=False, login_disabled=False):
+# Limits of the operations that can scan the whole story table (see StoriesService.limits)
+RATE_LIMITS = {
+    'getStories': {'rate': 5, 'burst': 20, 'concurrency': 8},
+    'getRangeStories': {'rate': 5, 'burst': 20, 'concurrency': 8},
+    'search': {'rate': 5, 'burst': 20, 'concurrency': 8},
+}
+
+
+def create_app(database=DEFAULT_DB, wtf=False, login_disabled=False, rate_limits=None, rate_limit_storage=None,
+               broker=DEFAULT_BROKER, archive_after_days=365, dedup_window_minutes=60, profiling=False):
     flask_app = Flask(__name__)
     flask_app.config['TESTING'] = True
     flask_app.config['WTF_CSRF_SECRET_KEY'] = 'A SECRET KEY'
     flask_app.config['SECRET_KEY'] = 'ANOTHER ONE'
     flask_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Recording (on by default with TESTING) keeps every statement and its parameters until the end of the
+    # app context: the memory of `flask import`/`flask export` would grow with the table
+    flask_app.config['SQLALCHEMY_RECORD_QUERIES'] = False
     flask_app.config['SQLALCHEMY_DATABASE_URI'] = database
     flask_app.config['WTF_CSRF_ENABLED'] = wtf
     flask_app.config['LOGIN_DISABLED'] = login_disabled
+    flask_app.config['RATE_LIMITS'] = RATE_LIMITS if rate_limits is None else rate_limits
+    # None keeps the buckets in process, a redis:// URL shares them between processes
+    flask_app.config['RATE_LIMIT_STORAGE'] = rate_limit_storage
+    # Post-publish side effects are queued here (worker: celery -A StoriesService.app.celery worker)
+    flask_app.config['CELERY_BROKER_URL'] = broker
+    # Age of the published stories moved to the archive by `flask archive`
+    flask_app.config['ARCHIVE_AFTER_DAYS'] = archive_after_days
+    # Duplicate writes are detected in this window (None disables the check)
+    flask_app.config['DEDUP_WINDOW'] = datetime.timedelta(minutes=dedup_window_minutes) \
+        if dedup_window_minutes else None
+    # Profiling of single requests (see StoriesService.profiling), off by default
+    flask_app.config['PROFILING_ENABLED'] = profiling
+    # Key of the profiling tokens, required to enable profiling
+    flask_app.config['PROFILING_SECRET'] = os.environ.get('PROFILING_SECRET')
+    flask_app.config['PROFILING_SAMPLE_RATE'] = 0.0
+    flask_app.config['PROFILING_FORMAT'] = 'pstats'
+    flask_app.config['PROFILING_DIR'] = default_directory()
+    flask_app.config['PROFILING_KEEP'] = 50
+    flask_app.config['PROFILING_TOKEN_MAX_AGE'] = 3600
+    # Pre-encoded responses of the public feed (see StoriesService.feed)
+    flask_app.config['FEED_SNAPSHOTS'] = True
+    flask_app.config['FEED_GZIP_LEVEL'] = 6
+    flask_app.config['FEED_BROTLI_QUALITY'] = 5
 
     for bp in blueprints:
         flask_app.register_blueprint(bp)
         bp.app = flask_app
 
     db.init_app(flask_app)
-    db.create_all(app=flask_app)
+    # Missing tables are created, the ones of earlier versions upgraded (see StoriesService.schema)
+    upgrade_schema(db.get_engine(flask_app))
+    init_repository(flask_app)
+    Limiter(flask_app)
+    Profiling(flask_app)
+    FeedSnapshots(flask_app)
+    init_celery(flask_app)
+    flask_app.cli.add_command(archive_command)
+    flask_app.cli.add_command(profile_token_command)
+    flask_app.cli.add_command(figures_command)
+    flask_app.cli.add_command(export_command)
+    flask_app.cli.add_command(import_command)
 
     return flask_app
 
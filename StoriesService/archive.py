@@ -0,0 +1,79 @@
+# encoding: utf8
+import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import desc, or_, and_
+
+from StoriesService.database import db, Story, ArchivedStory, bump_feed_version
+
+BATCH_SIZE = 500
+
+
+# Moves the published stories written before `before` from the story table to the archive.
+# Rows are removed with a Core delete: archived stories still count in the author counters,
+# the feed version is bumped here instead
+def archive_stories(before, batch_size=BATCH_SIZE):
+    moved = 0
+    while True:
+        batch = Story.query.filter(Story.is_draft == False, Story.date < before) \
+            .order_by(Story.id).limit(batch_size).all()
+        if not batch:
+            return moved
+        db.session.add_all([ArchivedStory.from_story(story) for story in batch])
+        ids = [story.id for story in batch]
+        db.session.execute(Story.__table__.delete().where(Story.id.in_(ids)))
+        bump_feed_version(db.session.connection())
+        db.session.commit()
+        db.session.expunge_all()
+        moved += len(batch)
+
+
+# Lookups in the archive, returning detached Story objects
+
+def archived_story(id_story):
+    archived = ArchivedStory.query.get(id_story)
+    return archived.to_story() if archived is not None else None
+
+
+def archived_range(begin_date, end_date):
+    q = ArchivedStory.query.filter(ArchivedStory.date >= begin_date, ArchivedStory.date <= end_date) \
+        .order_by(ArchivedStory.id)
+    return [archived.to_story() for archived in q]
+
+
+def archived_timeline(author_id, before=None, limit=None, before_id=None):
+    q = ArchivedStory.query.filter(ArchivedStory.author_id == author_id)
+    if before is not None:
+        q = q.filter(ArchivedStory.date < before if before_id is None else
+                     or_(ArchivedStory.date < before, and_(ArchivedStory.date == before, ArchivedStory.id < before_id)))
+    q = q.order_by(desc(ArchivedStory.date), desc(ArchivedStory.id))
+    if limit is not None:
+        q = q.limit(limit)
+    return [archived.to_story() for archived in q]
+
+
+def archived_figures(author_id):
+    return [figures for figures, in db.session.query(ArchivedStory.figures)
+            .filter(ArchivedStory.author_id == author_id)]
+
+
+# Through the ORM, so that the author counters follow
+def delete_archived(id_story):
+    archived = ArchivedStory.query.get(id_story)
+    if archived is not None:
+        db.session.delete(archived)
+
+
+@click.command('archive')
+@with_appcontext
+@click.option('--days', type=int, default=None,
+              help='Archive the published stories older than this (default: ARCHIVE_AFTER_DAYS)')
+def archive_command(days):
+    """Move old published stories to the compressed archive."""
+    if days is None:
+        days = current_app.config['ARCHIVE_AFTER_DAYS']
+    before = datetime.datetime.now() - datetime.timedelta(days=days)
+    moved = archive_stories(before)
+    click.echo('Archived %d stories older than %s' % (moved, before.strftime('%Y-%m-%d')))
@@ -0,0 +1,286 @@
+# encoding: utf8
+import csv
+import datetime
+import io
+import os
+import zlib
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select, func
+
+from StoriesService.database import db, Story, ArchivedStory, RecentWrite, FigureSketch, bump_feed_version
+from StoriesService.schema import continue_ids, rebuild_author_counters
+
+# Rows held in memory at once, by export and import
+BATCH_SIZE = 10000
+COLUMNS = ('id', 'text', 'date', 'figures', 'author_id', 'is_draft', 'content_hash')
+# Columns of the files: archived stories are exported with their (uncompressed) text and archived = true
+FILE_COLUMNS = COLUMNS + ('archived',)
+ARCHIVED_COLUMNS = ('id', 'date', 'figures', 'author_id', 'data')
+EXTENSIONS = {
+    '.parquet': 'parquet',
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+    '.csv': 'csv',
+}
+
+
+# Format given, or the one of the file extension (csv if unknown)
+def file_format(path, given=None):
+    return given or EXTENSIONS.get(os.path.splitext(path)[1].lower(), 'csv')
+
+
+def _pyarrow(name):
+    try:
+        import pyarrow
+        return pyarrow
+    except ImportError:
+        raise ValueError('pyarrow is needed for the %s format, use csv' % name)
+
+
+def _schema(pa):
+    return pa.schema([('id', pa.int64()), ('text', pa.string()), ('date', pa.timestamp('us')),
+                      ('figures', pa.string()), ('author_id', pa.int64()), ('is_draft', pa.bool_()),
+                      ('content_hash', pa.string()), ('archived', pa.bool_())])
+
+
+def _record_batch(pa, schema, rows):
+    columns = list(zip(*rows))
+    return pa.RecordBatch.from_arrays([pa.array(column, field.type) for column, field in zip(columns, schema)],
+                                      schema=schema)
+
+
+# Writers: take an iterator of batches (lists of row tuples, in FILE_COLUMNS order)
+
+def write_parquet(path, batches):
+    pa = _pyarrow('parquet')
+    import pyarrow.parquet as pq
+    schema = _schema(pa)
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        for rows in batches:
+            writer.write_batch(_record_batch(pa, schema, rows))
+
+
+def write_arrow(path, batches):
+    pa = _pyarrow('arrow')
+    schema = _schema(pa)
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+        for rows in batches:
+            writer.write_batch(_record_batch(pa, schema, rows))
+
+
+def write_csv(path, batches):
+    with open(path, 'w', newline='', encoding='utf8') as f:
+        writer = csv.writer(f)
+        writer.writerow(FILE_COLUMNS)
+        for rows in batches:
+            writer.writerows((id_story, text, date.isoformat() if date else None, figures, author_id,
+                              int(is_draft) if is_draft is not None else None, content_hash, int(archived))
+                             for id_story, text, date, figures, author_id, is_draft, content_hash, archived in rows)
+
+
+# Readers: yield batches of rows (dicts) to insert. Files exported before the archive was exported
+# have no archived column
+
+def _file_columns(names):
+    return [column for column in FILE_COLUMNS if column in names]
+
+
+def read_parquet(path, batch_size):
+    _pyarrow('parquet')
+    import pyarrow.parquet as pq
+    source = pq.ParquetFile(path)
+    for batch in source.iter_batches(batch_size=batch_size, columns=_file_columns(source.schema_arrow.names)):
+        yield batch.to_pylist()
+
+
+def read_arrow(path, batch_size):
+    pa = _pyarrow('arrow')
+    # Not memory mapped: the pages read would stay in the RSS of the process
+    with pa.OSFile(path, 'rb') as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            columns = _file_columns(batch.schema.names)
+            for start in range(0, batch.num_rows, batch_size):
+                yield batch.slice(start, batch_size).select(columns).to_pylist()
+
+
+def _csv_value(column, value):
+    if value == '' and column != 'text':
+        return None
+    if column in ('id', 'author_id'):
+        return int(value)
+    if column in ('is_draft', 'archived'):
+        return value in ('1', 'True', 'true')
+    if column == 'date':
+        return datetime.datetime.fromisoformat(value)
+    return value
+
+
+def read_csv(path, batch_size):
+    with open(path, newline='', encoding='utf8') as f:
+        batch = []
+        reader = csv.DictReader(f)
+        columns = _file_columns(reader.fieldnames or ())
+        for row in reader:
+            batch.append({column: _csv_value(column, row[column]) for column in columns})
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+WRITERS = {
+    'parquet': write_parquet,
+    'arrow': write_arrow,
+    'csv': write_csv,
+}
+READERS = {
+    'parquet': read_parquet,
+    'arrow': read_arrow,
+    'csv': read_csv,
+}
+
+
+def _archived_file_row(row):
+    id_story, date, figures, author_id, data = row
+    return id_story, zlib.decompress(data).decode('utf8'), date, figures, author_id, False, None, True
+
+
+# Writes the story table, then the archive, to a file, reading them with a (server side, where supported) cursor.
+# Returns the number of stories
+def export_stories(path, fmt, batch_size=BATCH_SIZE):
+    connection = db.session.connection().execution_options(stream_results=True)
+    exported = 0
+
+    def rows_of(table, columns, file_row):
+        nonlocal exported
+        result = connection.execute(select([table.c[column] for column in columns]).order_by(table.c.id))
+        try:
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    return
+                exported += len(rows)
+                yield [file_row(row) for row in rows]
+        finally:
+            result.close()
+
+    def batches():
+        yield from rows_of(Story.__table__, COLUMNS, lambda row: tuple(row) + (False,))
+        yield from rows_of(ArchivedStory.__table__, ARCHIVED_COLUMNS, _archived_file_row)
+
+    WRITERS[fmt](path, batches())
+    return exported
+
+
+def _insert(connection, table, columns, rows):
+    connection.execute(table.insert(), rows)
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, str):
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    if isinstance(value, bytes):
+        # bytea hex format, its backslash escaped
+        return '\\\\x' + value.hex()
+    return str(value)
+
+
+# PostgreSQL: COPY (text format) instead of one INSERT per row
+def _copy(connection, table, columns, rows):
+    data = io.StringIO()
+    for row in rows:
+        data.write('\t'.join(_copy_value(row[column]) for column in columns))
+        data.write('\n')
+    data.seek(0)
+    connection.connection.cursor().copy_expert('COPY %s (%s) FROM STDIN' % (table.name, ', '.join(columns)), data)
+
+
+INSERTS = {
+    'postgresql': _copy,
+}
+
+
+# Loads the stories of a file into the (empty, unless replace) story and archive tables, in a single transaction.
+# Bulk inserts bypass the mapper events: the indexes of the story table are dropped and rebuilt afterwards,
+# then the author counters are recomputed and the feed version is bumped. The remembered writes and the figure
+# sketches (of the previous stories) are emptied, `flask figures --rebuild` computes the sketches of the new ones.
+# Returns the number of stories
+def import_stories(path, fmt, batch_size=BATCH_SIZE, replace=False):
+    table, archive = Story.__table__, ArchivedStory.__table__
+    connection = db.session.connection()
+    if replace:
+        connection.execute(table.delete())
+        connection.execute(archive.delete())
+    elif connection.execute(select([func.count()]).select_from(table)).scalar() or \
+            connection.execute(select([func.count()]).select_from(archive)).scalar():
+        raise ValueError('The story table is not empty (use --replace)')
+    connection.execute(RecentWrite.__table__.delete())
+    connection.execute(FigureSketch.__table__.delete())
+
+    for index in table.indexes:
+        index.drop(connection)
+    insert = INSERTS.get(connection.dialect.name, _insert)
+    imported = 0
+    for rows in READERS[fmt](path, batch_size):
+        stories = [{column: row[column] for column in COLUMNS} for row in rows if not row.get('archived')]
+        archived = [{'id': row['id'], 'date': row['date'], 'figures': row['figures'], 'author_id': row['author_id'],
+                     'data': zlib.compress((row['text'] or '').encode('utf8'), 9)}
+                    for row in rows if row.get('archived')]
+        if stories:
+            insert(connection, table, COLUMNS, stories)
+        if archived:
+            insert(connection, archive, ARCHIVED_COLUMNS, archived)
+        imported += len(rows)
+    for index in table.indexes:
+        index.create(connection)
+
+    continue_ids(connection)
+    if connection.dialect.name == 'postgresql':
+        connection.execute('ANALYZE story')
+    rebuild_author_counters(connection)
+    bump_feed_version(connection)
+    db.session.commit()
+    return imported
+
+
+@click.command('export')
+@with_appcontext
+@click.argument('path', type=click.Path(dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(sorted(WRITERS)), default=None,
+              help='parquet, arrow (IPC file) or csv (default: from the extension, csv otherwise)')
+@click.option('--batch-size', type=int, default=BATCH_SIZE, help='Rows read and written at once')
+def export_command(path, fmt, batch_size):
+    """Export the stories (archived ones included) to a Parquet, Arrow or CSV file."""
+    try:
+        exported = export_stories(path, file_format(path, fmt), batch_size)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo('Exported %d stories to %s' % (exported, path))
+
+
+@click.command('import')
+@with_appcontext
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(sorted(READERS)), default=None,
+              help='parquet, arrow (IPC file) or csv (default: from the extension, csv otherwise)')
+@click.option('--batch-size', type=int, default=BATCH_SIZE, help='Rows read and inserted at once')
+@click.option('--replace', is_flag=True, help='Delete the stories of the table first')
+def import_command(path, fmt, batch_size, replace):
+    """Import stories from a Parquet, Arrow or CSV file."""
+    try:
+        imported = import_stories(path, file_format(path, fmt), batch_size, replace)
+    except ValueError as e:
+        db.session.rollback()
+        raise click.ClickException(str(e))
+    click.echo('Imported %d stories from %s (figure statistics: flask figures --rebuild)' % (imported, path))
@@ -1,21 +1,31 @@
 # encoding: utf8
 import datetime as dt
+import zlib
 from builtins import isinstance, getattr, super
 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
 
 db = SQLAlchemy()
 
 class Story(db.Model):
     __tablename__ = 'story'
+    # Access path for the per-author timelines (published stories and drafts, newest first)
+    __table_args__ = (
+        db.Index('ix_story_author_draft_date', 'author_id', 'is_draft', db.text('date DESC')),
+        # Ids of archived stories must never be reused
+        {'sqlite_autoincrement': True},
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    text = db.Column(db.Text(1000))  # around 200 (English) words
+    text = db.Column(db.Text)  # up to 1000 characters (check_validity), around 200 (English) words
     date = db.Column(db.DateTime)
     figures = db.Column(db.Unicode(128))
     # define foreign key
     author_id = db.Column(db.Integer)
     is_draft = db.Column(db.Boolean, default=True)
+    # sha256 of author, figures and normalized text (see StoriesService.dedup)
+    content_hash = db.Column(db.String(64), index=True)
 
     def __init__(self, *args, **kw):
         super(Story, self).__init__(*args, **kw)
@@ -30,3 +40,129 @@ class Story(db.Model):
             json[attr] = value
         return json
 
+
+# Recent writes, by content hash and Idempotency-Key, with the response that was returned.
+# The unique key makes concurrent duplicates fail; rows older than DEDUP_WINDOW are pruned
+class RecentWrite(db.Model):
+    __tablename__ = 'recent_write'
+
+    key = db.Column(db.String(128), primary_key=True)
+    story_id = db.Column(db.Integer)
+    date = db.Column(db.DateTime, index=True)
+    status = db.Column(db.Integer)
+    description = db.Column(db.Unicode(128))
+
+
+# Cold store of old published stories: append-only, the text is zlib-compressed.
+# Only the columns used for lookups (id, author, date) and the figures are kept in clear
+class ArchivedStory(db.Model):
+    __tablename__ = 'story_archive'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    date = db.Column(db.DateTime, index=True)
+    figures = db.Column(db.Unicode(128))
+    author_id = db.Column(db.Integer, index=True)
+    data = db.Column(db.LargeBinary)
+
+    @classmethod
+    def from_story(cls, story):
+        return cls(id=story.id, date=story.date, figures=story.figures, author_id=story.author_id,
+                   data=zlib.compress((story.text or '').encode('utf8'), 9))
+
+    # Detached Story, to be used (and serialized) as the stories of the hot table
+    def to_story(self):
+        story = Story(id=self.id, figures=self.figures, author_id=self.author_id, is_draft=False,
+                      text=zlib.decompress(self.data).decode('utf8'))
+        story.date = self.date
+        return story
+
+
+# Number of published stories and drafts of each author, kept up to date on every write
+class AuthorCounter(db.Model):
+    __tablename__ = 'author_counter'
+
+    author_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    num_stories = db.Column(db.Integer, nullable=False, default=0)
+    num_drafts = db.Column(db.Integer, nullable=False, default=0)
+
+    def count(self, is_draft):
+        return self.num_drafts if is_draft else self.num_stories
+
+
+# Serialized sketches of StoriesService.analytics, each of a bounded size
+class FigureSketch(db.Model):
+    __tablename__ = 'figure_sketch'
+
+    name = db.Column(db.Unicode(160), primary_key=True)
+    data = db.Column(db.LargeBinary)
+
+
+# Version of the public feed (published stories), bumped in the transaction of every write changing it.
+# Shared by all the processes, it tells when the snapshots of StoriesService.feed are stale
+class FeedVersion(db.Model):
+    __tablename__ = 'feed_version'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+FEED_VERSION_ID = 1
+
+
+def bump_feed_version(connection):
+    table = FeedVersion.__table__
+    updated = connection.execute(
+        table.update().where(table.c.id == FEED_VERSION_ID).values(version=table.c.version + 1))
+    if updated.rowcount == 0:
+        connection.execute(table.insert().values(id=FEED_VERSION_ID, version=1))
+
+
+def _bump_counter(connection, author_id, is_draft, delta):
+    if author_id is None:
+        return
+    table = AuthorCounter.__table__
+    column = 'num_drafts' if is_draft else 'num_stories'
+    updated = connection.execute(
+        table.update().where(table.c.author_id == author_id).values({column: table.c[column] + delta}))
+    if updated.rowcount == 0:
+        values = {'author_id': author_id, 'num_stories': 0, 'num_drafts': 0}
+        values[column] = delta
+        connection.execute(table.insert().values(values))
+
+
+# Counters and the feed version are maintained by mapper events, so every ORM write (views or not) keeps them consistent.
+# Bulk Query.update()/Query.delete() bypass these events and must not be used on Story.
+@event.listens_for(Story, 'after_insert')
+def _story_inserted(mapper, connection, target):
+    _bump_counter(connection, target.author_id, bool(target.is_draft), 1)
+    if not target.is_draft:
+        bump_feed_version(connection)
+
+
+@event.listens_for(Story, 'after_delete')
+def _story_deleted(mapper, connection, target):
+    _bump_counter(connection, target.author_id, bool(target.is_draft), -1)
+    if not target.is_draft:
+        bump_feed_version(connection)
+
+
+# Archived stories are counted as published (archive_stories moves them without the Story events)
+@event.listens_for(ArchivedStory, 'after_delete')
+def _archived_story_deleted(mapper, connection, target):
+    _bump_counter(connection, target.author_id, False, -1)
+
+
+@event.listens_for(Story, 'after_update')
+def _story_updated(mapper, connection, target):
+    state = inspect(target)
+    author = state.attrs.author_id.history
+    draft = state.attrs.is_draft.history
+    old_draft = draft.deleted[0] if draft.deleted else target.is_draft
+    # Edits of drafts don't change the feed
+    if not old_draft or not target.is_draft:
+        bump_feed_version(connection)
+    if not author.has_changes() and not draft.has_changes():
+        return
+    old_author = author.deleted[0] if author.deleted else target.author_id
+    _bump_counter(connection, old_author, bool(old_draft), -1)
+    _bump_counter(connection, target.author_id, bool(target.is_draft), 1)
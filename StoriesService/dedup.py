@@ -0,0 +1,52 @@
+# encoding: utf8
+import datetime
+import hashlib
+
+from sqlalchemy import desc
+
+from StoriesService.database import db, RecentWrite
+
+
+# Same author, same figures, same text (up to whitespace) and same kind (draft or published story)
+# give the same hash: publishing the text of a draft is not a duplicate of the draft
+def content_hash(author_id, figures, text, is_draft):
+    normalized = ' '.join(text.split())
+    content = '%s\x00%s\x00%s\x00%s' % (author_id, figures, bool(is_draft), normalized)
+    return hashlib.sha256(content.encode('utf8')).hexdigest()
+
+
+# Keys identifying a write: its content and, if given, the Idempotency-Key of the author
+def write_keys(author_id, hash_value, idempotency_key=None):
+    keys = ['content:' + hash_value]
+    if idempotency_key:
+        keys.append('key:%s:%s' % (author_id, idempotency_key[:64]))
+    return keys
+
+
+# Returns the write that already used one of the keys in the last `window` (timedelta), if any.
+# The Idempotency-Key ('key:...') comes before the content
+def recent_write(keys, window):
+    RecentWrite.query.filter(RecentWrite.date < datetime.datetime.now() - window).delete()
+    return RecentWrite.query.filter(RecentWrite.key.in_(keys)).order_by(desc(RecentWrite.key)).first()
+
+
+# A write is replayed while its story exists and, if it was found by its content, still has that content:
+# a draft edited since then is not a duplicate anymore
+def replayable(write, story, hash_value):
+    return story is not None and (not write.key.startswith('content:') or story.content_hash == hash_value)
+
+
+# Records the write (in the session of the story, so both are committed together)
+def remember_write(keys, story_id, status, description):
+    now = datetime.datetime.now()
+    db.session.add_all([RecentWrite(key=key, story_id=story_id, date=now, status=status, description=description)
+                        for key in keys])
+
+
+# Forgets the writes of a story, when it is deleted: writing it again is not a duplicate
+def forget_writes(story_id):
+    RecentWrite.query.filter(RecentWrite.story_id == story_id).delete(synchronize_session=False)
+
+
+def forget_write(key):
+    RecentWrite.query.filter(RecentWrite.key == key).delete(synchronize_session=False)
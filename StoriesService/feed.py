@@ -0,0 +1,89 @@
+# encoding: utf8
+import gzip
+import hashlib
+import threading
+
+from flask import request, jsonify, current_app
+from sqlalchemy import select
+
+from StoriesService.database import db, FeedVersion, FEED_VERSION_ID
+
+try:
+    import brotli
+except ImportError:  # optional, gzip only
+    brotli = None
+
+
+# Encoded bodies of a feed page: same content for every client, compressed once
+class Snapshot:
+
+    def __init__(self, version, body, gzip_level=6, brotli_quality=5):
+        self.version = version
+        self.bodies = {'identity': body, 'gzip': gzip.compress(body, gzip_level)}
+        if brotli is not None:
+            self.bodies['br'] = brotli.compress(body, quality=brotli_quality)
+        digest = hashlib.sha1(body).hexdigest()
+        # One ETag per representation, as they have different bytes
+        self.etags = {encoding: digest if encoding == 'identity' else '%s-%s' % (digest, encoding)
+                      for encoding in self.bodies}
+
+    # Best encoding accepted by the client, preferring the smallest
+    def encoding(self, accept_encodings):
+        offered = [encoding for encoding in ('br', 'gzip') if encoding in self.bodies]
+        return accept_encodings.best_match(offered, default='identity')
+
+
+# Materialized JSON responses of the public feed (GET /stories, /stories/latest).
+# A snapshot is rebuilt on the first request after the feed version changed (see FeedVersion):
+# any number of publishes and deletes in between cost a single rebuild. Otherwise a request
+# reads the version (primary key lookup) and returns the already encoded bytes
+class FeedSnapshots:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['feed'] = self
+        self.snapshots = {}
+        self._lock = threading.Lock()
+        self._version_query = None
+
+    # Compiled once: this lookup is most of the time of a request
+    def current_version(self):
+        if self._version_query is None:
+            table = FeedVersion.__table__
+            self._version_query = select([table.c.version]).where(table.c.id == FEED_VERSION_ID).compile(db.engine)
+        return db.session.connection().execute(self._version_query).scalar() or 0
+
+    # Snapshot of the page, `build` returns its content when it has to be rebuilt
+    def snapshot(self, name, build):
+        version = self.current_version()
+        snapshot = self.snapshots.get(name)
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+        # A single rebuild per process, the other requests wait for it
+        with self._lock:
+            snapshot = self.snapshots.get(name)
+            if snapshot is None or snapshot.version != version:
+                # Built after reading the version: the content is never older than the version
+                snapshot = Snapshot(version, jsonify(build()).get_data(),
+                                    current_app.config['FEED_GZIP_LEVEL'], current_app.config['FEED_BROTLI_QUALITY'])
+                self.snapshots[name] = snapshot
+        return snapshot
+
+    # Response with the encoded bytes of the page (304 if the client has them already)
+    def response(self, name, build):
+        if not current_app.config['FEED_SNAPSHOTS']:
+            return jsonify(build())
+        snapshot = self.snapshot(name, build)
+        encoding = snapshot.encoding(request.accept_encodings)
+        response = current_app.response_class(snapshot.bodies[encoding], mimetype='application/json')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.set_etag(snapshot.etags[encoding])
+        return response.make_conditional(request)
+
+
+def feed():
+    return current_app.extensions['feed']
@@ -0,0 +1,176 @@
+# encoding: utf8
+import math
+import threading
+import time
+
+from flask import request, g, jsonify, current_app
+
+
+# Token bucket kept in the memory of the process.
+# A bucket left alone for burst / rate seconds is full again, as a missing one: such buckets are dropped
+# (at most every PRUNE_INTERVAL seconds), as RedisStorage lets them expire
+class MemoryStorage:
+    PRUNE_INTERVAL = 60
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._pruned = None
+
+    # Takes a token from the bucket identified by key.
+    # Returns 0 if the request is allowed, otherwise the seconds to wait for the next token
+    def take(self, key, rate, burst, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            if self._pruned is None or now - self._pruned >= self.PRUNE_INTERVAL:
+                self._prune(now)
+            tokens, last, _ = self._buckets.get(key, (burst, now, None))
+            tokens = min(burst, tokens + (now - last) * rate)
+            if tokens >= 1:
+                wait = 0.0
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now, now + burst / rate)
+        return wait
+
+    def _prune(self, now):
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket[2] > now}
+        self._pruned = now
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+# Token bucket shared by all the processes through Redis, updated atomically by a Lua script
+class RedisStorage:
+    PREFIX = 'ratelimit:'
+    SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local last = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+    def __init__(self, client):
+        self._client = client
+        self._script = client.register_script(self.SCRIPT)
+
+    @classmethod
+    def from_url(cls, url):
+        import redis
+        return cls(redis.Redis.from_url(url))
+
+    # When Redis can't be reached the request is allowed (and the error logged): the limits are lost for a while,
+    # the service is not
+    def take(self, key, rate, burst, now=None):
+        from redis import RedisError
+        now = time.time() if now is None else now
+        try:
+            wait = self._script(keys=[self.PREFIX + key], args=[rate, burst, now])
+        except RedisError:
+            current_app.logger.exception('Rate limit storage unavailable, %s allowed', key)
+            return 0
+        return float(wait)
+
+
+# Number of in-flight requests of each operation in this process
+class ConcurrencyCounter:
+    def __init__(self):
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, operation, limit):
+        with self._lock:
+            current = self._in_flight.get(operation, 0)
+            if current >= limit:
+                return False
+            self._in_flight[operation] = current + 1
+            return True
+
+    def release(self, operation):
+        with self._lock:
+            self._in_flight[operation] -= 1
+
+    def in_flight(self, operation):
+        return self._in_flight.get(operation, 0)
+
+
+# Rate limiting (per client and operationId) and load shedding (per operationId).
+# Limits come from the RATE_LIMITS config, e.g.
+#   {'search': {'rate': 2, 'burst': 10, 'concurrency': 4, 'retry_after': 1}}
+# where rate is in tokens per second; every key is optional.
+# RATE_LIMIT_STORAGE is None (in process), a redis:// URL or a storage object
+class Limiter:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.limits = app.config.get('RATE_LIMITS', {})
+        storage = app.config.get('RATE_LIMIT_STORAGE')
+        if storage is None:
+            storage = MemoryStorage()
+        elif isinstance(storage, str):
+            storage = RedisStorage.from_url(storage)
+        self.storage = storage
+        self.concurrency = ConcurrencyCounter()
+
+        # (rule, method) -> operationId, from the swagger blueprints
+        self.operations = {}
+        for bp in app.blueprints.values():
+            for operation_id, op in getattr(bp, 'ops', {}).items():
+                rule = op['path'].replace('{', '<').replace('}', '>')
+                self.operations[(rule, op['method'])] = operation_id
+
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        app.extensions['limiter'] = self
+
+    def _operation(self):
+        if request.url_rule is None:
+            return None
+        return self.operations.get((request.url_rule.rule, request.method))
+
+    def _before_request(self):
+        operation = self._operation()
+        limits = self.limits.get(operation)
+        if not limits:
+            return None
+
+        if 'rate' in limits:
+            key = '%s:%s' % (operation, request.remote_addr)
+            wait = self.storage.take(key, limits['rate'], limits.get('burst', limits['rate']))
+            if wait > 0:
+                return _error(429, 'Too many requests, slow down', wait)
+
+        if 'concurrency' in limits:
+            if not self.concurrency.acquire(operation, limits['concurrency']):
+                return _error(503, 'Server is busy, try again later', limits.get('retry_after', 1))
+            g.limiter_operation = operation
+        return None
+
+    def _teardown_request(self, exc=None):
+        operation = g.pop('limiter_operation', None)
+        if operation is not None:
+            self.concurrency.release(operation)
+
+
+# Same body as the other errors of the service, plus the Retry-After header
+def _error(code, description, retry_after):
+    resp = jsonify(code=code, description=description, message=description)
+    resp.status_code = code
+    resp.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return resp
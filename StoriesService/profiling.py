@@ -0,0 +1,143 @@
+# encoding: utf8
+import cProfile
+import datetime
+import os
+import random
+import tempfile
+import time
+import uuid
+from collections import deque
+
+import click
+from flask import request, g, current_app
+from flask.cli import with_appcontext
+from itsdangerous import TimestampSigner, BadSignature
+
+# Header asking to profile a request, its value is a token from `flask profile-token`
+PROFILE_HEADER = 'X-Profile-Token'
+TOKEN_PAYLOAD = 'profile'
+
+
+# Tokens are signed with PROFILING_SECRET (from the environment): profiles expose the internals of the service,
+# they are not signed with the SECRET_KEY shared with the other uses of the app
+def _signer(app):
+    return TimestampSigner(app.config['PROFILING_SECRET'], salt='stories-profiling')
+
+
+def make_token(app):
+    return _signer(app).sign(TOKEN_PAYLOAD).decode('utf8')
+
+
+# True if the request carries a valid (and not expired) profiling token
+def valid_token(app, token):
+    if not token:
+        return False
+    try:
+        return _signer(app).unsign(token, max_age=app.config['PROFILING_TOKEN_MAX_AGE']) == TOKEN_PAYLOAD.encode()
+    except BadSignature:
+        return False
+
+
+# cProfile stats (pstats) of a request
+class PstatsCapture:
+    extension = 'prof'
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop(self, path):
+        self._profile.disable()
+        self._profile.dump_stats(path)
+
+
+# Speedscope file of a request, needs pyinstrument
+class SpeedscopeCapture:
+    extension = 'speedscope.json'
+
+    def __init__(self):
+        from pyinstrument import Profiler
+        self._profiler = Profiler()
+        self._profiler.start()
+
+    def stop(self, path):
+        from pyinstrument.renderers import SpeedscopeRenderer
+        self._profiler.stop()
+        with open(path, 'w') as f:
+            f.write(self._profiler.output(renderer=SpeedscopeRenderer()))
+
+
+CAPTURES = {
+    'pstats': PstatsCapture,
+    'speedscope': SpeedscopeCapture,
+}
+
+
+# Opt-in profiling of single requests: when PROFILING_ENABLED, a request is profiled if it carries
+# a valid X-Profile-Token header, or with probability PROFILING_SAMPLE_RATE.
+# The profile is saved in PROFILING_DIR and listed (the last PROFILING_KEEP ones) on /admin/profiles.
+# It can't be enabled without PROFILING_SECRET.
+# When disabled no hook is installed at all, so requests don't pay anything
+class Profiling:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['profiling'] = self
+        self.enabled = app.config.get('PROFILING_ENABLED', False)
+        if not self.enabled:
+            return
+        if not app.config.get('PROFILING_SECRET'):
+            raise RuntimeError('Profiling is enabled but PROFILING_SECRET is not set')
+        self.captures = deque(maxlen=app.config['PROFILING_KEEP'])
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def _before_request(self):
+        if request.path.startswith('/admin/'):
+            return
+        if valid_token(current_app, request.headers.get(PROFILE_HEADER)) or \
+                random.random() < current_app.config['PROFILING_SAMPLE_RATE']:
+            g.profile_start = time.perf_counter()
+            g.profile_capture = CAPTURES[current_app.config['PROFILING_FORMAT']]()
+
+    # Teardown, so that the requests ending with an error are saved too
+    def _teardown_request(self, exc=None):
+        capture = g.pop('profile_capture', None)
+        if capture is None:
+            return
+        duration = (time.perf_counter() - g.pop('profile_start')) * 1000
+        date = datetime.datetime.now()
+        name = '%s-%s.%s' % (date.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8], capture.extension)
+        directory = current_app.config['PROFILING_DIR']
+        os.makedirs(directory, exist_ok=True)
+        capture.stop(os.path.join(directory, name))
+        # The oldest capture leaves the list: its file goes with it
+        if len(self.captures) == self.captures.maxlen:
+            try:
+                os.remove(os.path.join(directory, self.captures[-1]['name']))
+            except OSError:
+                pass
+        self.captures.appendleft({
+            'name': name,
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'error': exc is not None,
+            'duration_ms': round(duration, 2),
+            'date': date,
+        })
+
+
+@click.command('profile-token')
+@with_appcontext
+def profile_token_command():
+    """Print a token for the X-Profile-Token header."""
+    if not current_app.config.get('PROFILING_SECRET'):
+        raise click.ClickException('PROFILING_SECRET is not set')
+    click.echo(make_token(current_app))
+
+
+def default_directory():
+    return os.path.join(tempfile.gettempdir(), 'stories-profiles')
@@ -0,0 +1,165 @@
+# encoding: utf8
+from random import randint
+
+from flask import current_app
+from sqlalchemy import desc, func, tablesample, or_, and_
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import aliased
+
+from StoriesService.archive import archived_story, archived_range, archived_timeline, archived_figures, \
+    delete_archived
+from StoriesService.database import db, Story
+from StoriesService.dedup import forget_writes
+
+
+# Reads and writes of stories. The queries of this class are portable (SQLite, PostgreSQL, MySQL 8);
+# the subclasses replace some of them with a faster, dialect specific version.
+# Archived stories are looked up transparently where the API still returns them
+class StoryRepository:
+
+    # Story by id, from the archive too unless it has to be modified
+    def get(self, id_story, include_archive=True):
+        story = Story.query.get(id_story)
+        if story is None and include_archive:
+            story = archived_story(id_story)
+        return story
+
+    def add(self, story):
+        db.session.add(story)
+
+    # Through the ORM, so that the author counters follow
+    def delete(self, story):
+        forget_writes(story.id)
+        if story in db.session:
+            db.session.delete(story)
+        else:
+            # The detached copy of an archived story
+            delete_archived(story.id)
+
+    # All the published stories, newest first
+    def published(self):
+        return Story.query.filter(Story.is_draft == False).order_by(desc(Story.date), desc(Story.id)).all()
+
+    # The last published story of each author, newest first
+    def latest_per_author(self):
+        rank = func.row_number().over(partition_by=Story.author_id,
+                                      order_by=(desc(Story.date), desc(Story.id))).label('rank')
+        ranked = db.session.query(Story.id.label('id'), rank).filter(Story.is_draft == False).subquery()
+        return Story.query.join(ranked, ranked.c.id == Story.id).filter(ranked.c.rank == 1) \
+            .order_by(desc(Story.date), desc(Story.id)).all()
+
+    # Published stories written between the two dates (included), by id
+    def in_range(self, begin_date, end_date):
+        hot = Story.query.filter(Story.date >= begin_date, Story.date <= end_date, Story.is_draft == False) \
+            .order_by(Story.id).all()
+        return sorted(hot + archived_range(begin_date, end_date), key=lambda story: story.id)
+
+    def _recent(self, since, exclude_author=None):
+        q = Story.query.filter(Story.date >= since, Story.is_draft == False)
+        if exclude_author is not None:
+            q = q.filter(Story.author_id != exclude_author)
+        return q
+
+    # A random published story written since the given date, None if there are none
+    def random_recent(self, since, exclude_author=None):
+        q = self._recent(since, exclude_author)
+        candidates = q.count()
+        if candidates == 0:
+            return None
+        return q.order_by(Story.id).offset(randint(0, candidates - 1)).first()
+
+    # Published stories rolled with the given figure, by id
+    def search_figure(self, figure):
+        return Story.query.filter(Story.figures.like('%#' + figure + '#%'), Story.is_draft == False) \
+            .order_by(Story.id).all()
+
+    # Published stories (archived ones too) or drafts of an author, newest first.
+    # The cursor is the (date, id) of the last story of the previous page: stories are written in the same minute
+    def timeline(self, author_id, is_draft, before=None, limit=None, before_id=None):
+        q = Story.query.filter(Story.author_id == author_id, Story.is_draft == is_draft)
+        if before is not None:
+            q = q.filter(Story.date < before if before_id is None else
+                         or_(Story.date < before, and_(Story.date == before, Story.id < before_id)))
+        q = q.order_by(desc(Story.date), desc(Story.id))
+        if limit is not None:
+            q = q.limit(limit)
+        timeline = q.all()
+
+        # A draft published late can be older than archived stories: both tiers are read, then merged
+        if not is_draft:
+            timeline += archived_timeline(author_id, before, limit, before_id)
+            timeline.sort(key=lambda story: (story.date, story.id), reverse=True)
+            timeline = timeline[:limit]
+        return timeline
+
+    # Figures of all the stories (drafts included) of an author
+    def figures_of(self, author_id):
+        hot = [figures for figures, in db.session.query(Story.figures).filter(Story.author_id == author_id)]
+        return hot + archived_figures(author_id)
+
+
+class SQLiteStoryRepository(StoryRepository):
+
+    # Bare columns of an aggregate query with max() come from the row holding the max. The max is taken on
+    # the date (stored as fixed width text) followed by the padded id: on a tie, the last written story of the minute
+    def latest_per_author(self):
+        rows = db.session.query(Story, func.max(func.printf('%s %010d', Story.date, Story.id))) \
+            .filter(Story.is_draft == False) \
+            .group_by(Story.author_id).order_by(desc(Story.date), desc(Story.id)).all()
+        return [story for story, _ in rows]
+
+    # One pass on the recent stories (date index), keeping a single row
+    def random_recent(self, since, exclude_author=None):
+        return self._recent(since, exclude_author).order_by(func.random()).limit(1).first()
+
+
+class PostgresStoryRepository(StoryRepository):
+    # Below this number of candidates, sampling is not worth it
+    SAMPLE_MIN_ROWS = 10000
+    # Expected number of candidates in the sample
+    SAMPLE_ROWS = 100
+
+    # Walks the (author_id, is_draft, date DESC) index keeping the first row of each author
+    # (on a tie, the last written of the stories of the same minute)
+    def latest_per_author(self):
+        latest = Story.query.filter(Story.is_draft == False).distinct(Story.author_id) \
+            .order_by(Story.author_id, desc(Story.date), desc(Story.id)).subquery()
+        story = aliased(Story, latest)
+        return db.session.query(story).order_by(desc(story.date), desc(story.id)).all()
+
+    # Number of rows of a query estimated by the planner, without running it
+    def _estimated_rows(self, q):
+        statement = q.statement.compile(dialect=db.session.bind.dialect)
+        plan = db.session.connection().execute('EXPLAIN (FORMAT JSON) ' + str(statement), statement.params).scalar()
+        return plan[0]['Plan']['Plan Rows']
+
+    # Many candidates (estimated, counting them would scan them): pick among a sample of the table pages
+    # instead of walking to a random offset
+    def random_recent(self, since, exclude_author=None):
+        candidates = self._estimated_rows(self._recent(since, exclude_author))
+        if candidates >= self.SAMPLE_MIN_ROWS:
+            percent = min(100.0, 100.0 * self.SAMPLE_ROWS / candidates)
+            story = aliased(Story, tablesample(Story.__table__, func.system(percent)))
+            q = db.session.query(story).filter(story.date >= since, story.is_draft == False)
+            if exclude_author is not None:
+                q = q.filter(story.author_id != exclude_author)
+            sampled = q.order_by(func.random()).limit(1).first()
+            if sampled is not None:
+                return sampled
+        return super(PostgresStoryRepository, self).random_recent(since, exclude_author)
+
+
+REPOSITORIES = {
+    'sqlite': SQLiteStoryRepository,
+    'postgresql': PostgresStoryRepository,
+}
+
+
+# Repository for the database of the app, picked from the dialect of its URI
+def init_app(flask_app):
+    backend = make_url(flask_app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name()
+    flask_app.extensions['stories_repository'] = REPOSITORIES.get(backend, StoryRepository)()
+
+
+def repository():
+    return current_app.extensions['stories_repository']
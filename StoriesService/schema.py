@@ -0,0 +1,88 @@
+# encoding: utf8
+from collections import defaultdict
+
+from sqlalchemy import inspect, select, func
+
+from StoriesService.database import db, Story, ArchivedStory, AuthorCounter
+
+
+# Ids were given explicitly (copied or imported): new stories must get ids after them, and after the archived ones
+def continue_ids(connection):
+    last = max(connection.execute(select([func.max(Story.id)])).scalar() or 0,
+               connection.execute(select([func.max(ArchivedStory.id)])).scalar() or 0)
+    if connection.dialect.name == 'postgresql':
+        connection.execute(select([func.setval(func.pg_get_serial_sequence('story', 'id'), max(last, 1),
+                                               last > 0)]))
+    elif connection.dialect.name == 'sqlite':
+        updated = connection.execute("UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name = 'story'", last)
+        if updated.rowcount == 0:
+            connection.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('story', ?)", last)
+
+
+# Author counters of the stories in the tables (archived stories are counted as published)
+def rebuild_author_counters(connection):
+    counts = defaultdict(lambda: {'num_stories': 0, 'num_drafts': 0})
+    for author_id, is_draft, count in connection.execute(
+            select([Story.author_id, Story.is_draft, func.count()]).group_by(Story.author_id, Story.is_draft)):
+        counts[author_id]['num_drafts' if is_draft else 'num_stories'] += count
+    for author_id, count in connection.execute(
+            select([ArchivedStory.author_id, func.count()]).group_by(ArchivedStory.author_id)):
+        counts[author_id]['num_stories'] += count
+    connection.execute(AuthorCounter.__table__.delete())
+    rows = [dict(values, author_id=author_id) for author_id, values in counts.items() if author_id is not None]
+    if rows:
+        connection.execute(AuthorCounter.__table__.insert(), rows)
+
+
+# SQLite only: a story table created without AUTOINCREMENT reuses the ids of deleted (and archived) stories.
+# The table can't be altered, it is copied into a new one
+def _rebuild_sqlite_story(connection):
+    if connection.dialect.name != 'sqlite':
+        return
+    sql = connection.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'story'").scalar()
+    if 'AUTOINCREMENT' in sql.upper():
+        return
+    inspector = inspect(connection)
+    columns = ', '.join('"%s"' % column['name'] for column in inspector.get_columns('story'))
+    for index in inspector.get_indexes('story'):
+        connection.execute('DROP INDEX "%s"' % index['name'])
+    connection.execute('ALTER TABLE story RENAME TO story_upgrade')
+    Story.__table__.create(connection)
+    connection.execute('INSERT INTO story (%s) SELECT %s FROM story_upgrade' % (columns, columns))
+    connection.execute('DROP TABLE story_upgrade')
+    continue_ids(connection)
+
+
+# Missing (nullable) columns of the existing tables
+def _add_columns(connection):
+    inspector = inspect(connection)
+    for table in db.metadata.sorted_tables:
+        columns = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name, column.type.compile(connection.dialect)))
+
+
+# Indexes added to the models after their tables were created (e.g. the one of the author timelines)
+def _add_indexes(connection):
+    inspector = inspect(connection)
+    for table in db.metadata.sorted_tables:
+        indexes = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(connection)
+
+
+# Creates the missing tables and brings the ones created by earlier versions up to the models: adds the missing
+# (nullable) columns and indexes, and AUTOINCREMENT to the SQLite story table. Counters created next to existing
+# stories are computed from them
+def upgrade_schema(engine):
+    with engine.begin() as connection:
+        existing = set(inspect(connection).get_table_names())
+        db.metadata.create_all(connection)
+        if 'story' in existing and AuthorCounter.__tablename__ not in existing:
+            rebuild_author_counters(connection)
+        _rebuild_sqlite_story(connection)
+        _add_columns(connection)
+        _add_indexes(connection)
@@ -0,0 +1,65 @@
+# encoding: utf8
+import requests
+from celery import Celery, Task
+from flask import has_app_context
+from sqlalchemy.exc import IntegrityError
+
+from StoriesService.analytics import record_story
+from StoriesService.database import db, Story
+
+NEW_REACTIONS_URL = "http://127.0.0.1:5004/new"
+
+
+# Tasks run inside the app context of the Flask app (the one of the request when run eagerly)
+class FlaskTask(Task):
+    def __call__(self, *args, **kwargs):
+        if has_app_context():
+            return super(FlaskTask, self).__call__(*args, **kwargs)
+        with self.app.flask_app.app_context():
+            return super(FlaskTask, self).__call__(*args, **kwargs)
+
+
+celery = Celery('StoriesService', task_cls=FlaskTask)
+
+
+# Configures the Celery app from the Flask one.
+# With the in-memory broker (tests) there is no worker, so tasks are run eagerly
+def init_app(flask_app):
+    broker = flask_app.config['CELERY_BROKER_URL']
+    celery.conf.update(
+        broker_url=broker,
+        task_always_eager=flask_app.config.get('CELERY_ALWAYS_EAGER', broker.startswith('memory://')),
+        task_ignore_result=True,
+    )
+    celery.flask_app = flask_app
+    flask_app.extensions['celery'] = celery
+    return celery
+
+
+class ReactionServiceError(Exception):
+    pass
+
+
+# Side effects of a publication, run after the story has been committed
+@celery.task(autoretry_for=(requests.RequestException, ReactionServiceError),
+             retry_backoff=True, max_retries=5)
+def story_published(story_id):
+    r = requests.post(NEW_REACTIONS_URL, json={"story_id": story_id})
+    if r.status_code >= 300:
+        raise ReactionServiceError("Error calling ReactionService")
+
+
+# Adds a published story to the figure sketches (StoriesService.analytics).
+# Apart from the story_published task: a retry of the ReactionService call must not count it twice
+@celery.task(autoretry_for=(IntegrityError,), retry_backoff=True, max_retries=5)
+def figures_published(story_id):
+    story = Story.query.get(story_id)
+    if story is None or story.is_draft:
+        return
+    try:
+        record_story(story)
+        db.session.commit()
+    except IntegrityError:
+        # Sketch rows created at the same time by another worker
+        db.session.rollback()
+        raise
@@ -1,7 +1,16 @@
-# Database in memory
-TEST_DB = 'sqlite:///:memory:'
+import os
 
-# Database "storytellers.db"
-DEFAULT_DB = 'sqlite:///stories-service.db'
+# Database in memory, STORIES_TEST_DB runs the tests on another backend (e.g. postgresql://...)
+TEST_DB = os.environ.get('STORIES_TEST_DB', 'sqlite:///:memory:')
 
-RANGE_URL = '/stories/range/'
\ No newline at end of file
+# Database "storytellers.db", STORIES_DB selects another backend
+DEFAULT_DB = os.environ.get('STORIES_DB', 'sqlite:///stories-service.db')
+
+# Database of the benchmarks, which empty it: STORIES_BENCH_DB, never the one of the service (default: a temporary file)
+BENCH_DB = os.environ.get('STORIES_BENCH_DB')
+
+# Celery brokers: in memory (tasks run eagerly) and local Redis
+TEST_BROKER = 'memory://'
+DEFAULT_BROKER = 'redis://localhost:6379/0'
+
+RANGE_URL = '/stories/range/'
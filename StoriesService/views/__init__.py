@@ -1,3 +1,4 @@
+from .admin import admin
 from .stories import stories
 
-blueprints = [stories]
\ No newline at end of file
+blueprints = [stories, admin]
@@ -0,0 +1,32 @@
+import os
+
+from flakon import SwaggerBlueprint
+from flask import request, jsonify, abort, current_app, send_from_directory
+
+from StoriesService.profiling import PROFILE_HEADER, valid_token
+
+YML = os.path.join(os.path.dirname(__file__), '.', 'admin-api.yaml')
+admin = SwaggerBlueprint('admin', '__name__', swagger_spec=YML)
+
+
+# Profiling extension, if enabled and the request is authorized
+def _profiling():
+    profiling = current_app.extensions['profiling']
+    if not profiling.enabled:
+        abort(404, 'Profiling is disabled')
+    if not valid_token(current_app, request.headers.get(PROFILE_HEADER)):
+        abort(403, 'Invalid profiling token')
+    return profiling
+
+
+@admin.operation('getProfiles')
+def _profiles():
+    return jsonify(list(_profiling().captures))
+
+
+@admin.operation('getProfile')
+def _profile(name):
+    profiling = _profiling()
+    if name not in [capture['name'] for capture in profiling.captures]:
+        abort(404, 'Specified profile not found')
+    return send_from_directory(current_app.config['PROFILING_DIR'], name, as_attachment=True)
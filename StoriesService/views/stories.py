@@ -1,19 +1,23 @@
 import datetime
 import os
 import string
-from random import randint
 
 import requests
 from flakon import SwaggerBlueprint
-from flask import request, jsonify, abort
-from sqlalchemy import func, desc, and_
+from flask import request, jsonify, abort, current_app
+from sqlalchemy.exc import IntegrityError
 
-from StoriesService.database import db, Story
+from StoriesService.database import db, Story, AuthorCounter
+from StoriesService.analytics import figures_summary, figure_details, TOP_CAPACITY
+from StoriesService.dedup import content_hash, write_keys, recent_write, remember_write, forget_writes, \
+    forget_write, replayable
+from StoriesService.feed import feed
+from StoriesService.repository import repository
+from StoriesService.tasks import story_published, figures_published
 
 YML = os.path.join(os.path.dirname(__file__), '.', 'stories-service-api.yaml')
 stories = SwaggerBlueprint('stories', '__name__', swagger_spec=YML)
 
-NEW_REACTIONS_URL = "http://127.0.0.1:5004/new"
 DELETE_REACTIONS_URL = "http://127.0.0.1:5004/delete"
 
 
@@ -39,11 +43,40 @@ def check_validity(text, figures):
     return message
 
 
+# Number of published stories (or drafts) of an author, read from the maintained counters
+def author_count(author_id, is_draft):
+    counter = AuthorCounter.query.get(author_id)
+    return counter.count(is_draft) if counter is not None else 0
+
+
+# Returns the timeline (published stories or drafts) of an author, newest first.
+# Query parameters: limit (max number of stories) and the cursor, exclusive: before (ISO datetime) and
+# before_id, the date and id of the last story of the previous page (stories can share the same minute)
+def author_timeline(author_id, is_draft):
+    limit = request.args.get('limit')
+    before = request.args.get('before')
+    before_id = request.args.get('before_id')
+    try:
+        if limit is not None:
+            limit = int(limit)
+            if limit <= 0:
+                raise ValueError
+        if before is not None:
+            before = datetime.datetime.fromisoformat(before)
+        if before_id is not None:
+            if before is None:
+                raise ValueError
+            before_id = int(before_id)
+    except ValueError:
+        abort(400, 'Invalid parameters')
+
+    return repository().timeline(author_id, is_draft, before, limit, before_id)
+
+
 @stories.operation('getStories')
 def _stories():
     if 'GET' == request.method:
-        all_stories = db.session.query(Story).order_by(desc(Story.date)).filter_by(is_draft=False).all()
-        return jsonify([story.to_json() for story in all_stories])
+        return feed().response('stories', lambda: [story.to_json() for story in repository().published()])
 
 
 @stories.operation('writeStory')
@@ -52,47 +85,89 @@ def _write_story(message=''):
         requestj = request.get_json(request)
         try:
             new_story = Story()
-            new_story.author_id = requestj['user_id']
+            new_story.author_id = int(requestj['user_id'])
             new_story.figures = requestj['figures']
             new_story.is_draft = requestj['as_draft']
             new_story.text = requestj['text']
             if new_story.is_draft:
                 # Response message for draft creation
-                # Insertion of a draft or a valid story in db
-                db.session.add(new_story)
-                db.session.commit()
                 message = 'Draft created'
             else:
                 validity = check_validity(new_story.text, new_story.figures)
                 if validity is not None:
                     abort(422, validity)
-                db.session.add(new_story)
-                db.session.commit()
-                r = requests.post(NEW_REACTIONS_URL, json={"story_id": new_story.id})
-                if r.status_code < 300:
-                    message = 'New story has been published'
-                else:
-                    abort(500, "Error calling ReactionService")
-
+                message = 'New story has been published'
+            new_story.content_hash = content_hash(new_story.author_id, new_story.figures, new_story.text,
+                                                  new_story.is_draft)
+
+            # Double submissions (same content or same Idempotency-Key) get the original result back,
+            # without writing anything or notifying ReactionService again
+            window = current_app.config['DEDUP_WINDOW']
+            keys = write_keys(new_story.author_id, new_story.content_hash, request.headers.get('Idempotency-Key'))
+            previous = recent_write(keys, window) if window else None
+            if previous is not None:
+                story = repository().get(previous.story_id)
+                if not replayable(previous, story, new_story.content_hash):
+                    # The story of the original write does not exist anymore, or has been edited: this is a new write
+                    if story is None:
+                        forget_writes(previous.story_id)
+                    else:
+                        forget_write(previous.key)
+                    previous = None
+            if previous is None:
+                # Insertion of a draft or a valid story in db
+                try:
+                    repository().add(new_story)
+                    db.session.flush()
+                    if window:
+                        remember_write(keys, new_story.id, 201, message)
+                    db.session.commit()
+                except IntegrityError:
+                    # A concurrent duplicate has been committed first
+                    db.session.rollback()
+                    previous = recent_write(keys, window)
+                    if previous is None:
+                        raise
+            if previous is not None:
+                return jsonify(description=previous.description), previous.status, {'Idempotent-Replayed': 'true'}
+
+            if not new_story.is_draft:
+                # ReactionService notification and the other side effects run in background
+                queue_published(new_story.id)
             return jsonify(description=message), 201
         # If values in request body aren't well-formed
-        except (ValueError, KeyError):
+        except (ValueError, KeyError, TypeError):
             abort(400, 'Wrong parameters')
 
 
+# Queues the side effects of a publication, once the story is committed. An unreachable broker doesn't
+# fail the request: the story is written, and a retry of the client would be replayed without queuing again.
+# The failure is logged with the story id instead
+def queue_published(story_id):
+    for task in (story_published, figures_published):
+        try:
+            task.delay(story_id)
+        except Exception:
+            current_app.logger.exception('Could not queue %s for story %d', task.name, story_id)
+
+
 # Open a story functionality (1.8)
 @stories.operation('getStory')
 def _open_story(id_story):
-    q = db.session.query(Story).filter(Story.id == id_story).all()
-    if q:
-        return jsonify(q[0].to_json())
+    story = repository().get(id_story)
+    if story is not None:
+        return jsonify(story.to_json())
     else:
         abort(404, 'Specified story not found')
 
 
 @stories.operation('getStoriesUser')
 def _user_story(id_user):
-    q = db.session.query(Story).filter(Story.author_id == id_user, Story.is_draft == False).all()
+    if not id_user.isdigit():
+        abort(400, 'Invalid parameters')
+    if request.args.get('count_only', '').lower() in ('1', 'true'):
+        return jsonify(count=author_count(int(id_user), False))
+    q = author_timeline(int(id_user), False)
     if q:
         return jsonify([story.to_json() for story in q])
     else:
@@ -107,45 +182,48 @@ def _update_draft(id_story):
             text = requestj['text']
             draft = requestj['as_draft']
             user_id = requestj['user_id']
-            q = db.session.query(Story).filter(Story.id == id_story).all()
-            if q and ((not q[0].is_draft) or q[0].author_id != int(user_id)):
+            story = repository().get(id_story, include_archive=False)
+            if story is None:
+                abort(404, 'Specified story not found')
+            if (not story.is_draft) or story.author_id != int(user_id):
                 abort(403, 'Request is invalid, check if you are the author of the story and it is still a draft')
             if draft:
                 message = 'Draft updated'
             else:
-                validity = check_validity(text, q[0].figures)
+                validity = check_validity(text, story.figures)
                 if validity is not None:
                     abort(422, validity)
-                r = requests.post(NEW_REACTIONS_URL, json={"story_id": id_story})
-                if r.status_code < 300:
-                    message = 'Story published'
-                else:
-                    abort(500, "Error calling ReactionService")
+                message = 'Story published'
 
             # Update a draft
             date_format = "%Y %m %d %H:%M"
             date = datetime.datetime.strptime(datetime.datetime.now().strftime(date_format), date_format)
-            db.session.query(Story).filter_by(id=id_story).update(
-                {'text': text, 'date': date, 'is_draft': draft})
+            # Changes go through the ORM (not a bulk update) so that the author counters follow
+            story.text = text
+            story.content_hash = content_hash(story.author_id, story.figures, text, draft)
+            story.date = date
+            story.is_draft = draft
             db.session.commit()
+            if not draft:
+                queue_published(story.id)
             status = 200
             return jsonify(description=message), status
-        except (ValueError, KeyError):
+        except (ValueError, KeyError, TypeError):
             abort(400, 'Errors in request body')
 
 
 @stories.operation('deleteStory')
 def _manage_stories(id_story):
     req = request.get_json(request)
-    story_to_delete = Story.query.filter(Story.id == id_story)
-    print(not req['user_id'] or not type(req['user_id']) is int or story_to_delete.first().author_id != req['user_id'])
-    if not req['user_id'] or not type(req['user_id']) is int or story_to_delete.first().author_id != req['user_id']:
+    story_to_delete = repository().get(id_story)
+    if story_to_delete is None:
+        abort(404, 'Specified story not found')
+    if not req['user_id'] or not type(req['user_id']) is int or story_to_delete.author_id != req['user_id']:
         abort(400, 'Request is invalid, check if you are the author of the story and the id is a valid one')
     else:
         r = requests.delete(DELETE_REACTIONS_URL, json={"story_id": id_story})
-        print(r)
         if r.status_code < 300:
-            story_to_delete.delete()
+            repository().delete(story_to_delete)
             db.session.commit()
             return jsonify(description='Story has been deleted')
         else:
@@ -155,10 +233,7 @@ def _manage_stories(id_story):
 # Gets the last NON-draft story for each registered user
 @stories.operation('getLatestStories')
 def _latest():
-    listed_stories = db.session.query(Story).order_by(desc(Story.date)).filter_by(is_draft=False).order_by(
-        func.max(Story.date)).group_by(
-        Story.author_id).all()
-    return jsonify([story.to_json() for story in listed_stories])
+    return feed().response('latest', lambda: [story.to_json() for story in repository().latest_per_author()])
 
 
 # Searches for stories that were made in a specific range of time
@@ -186,9 +261,7 @@ def _range():
             abort(400, "Begin date cannot be higher than End date")
 
         # Returns all the NON-draft stories that are between the requested dates
-        listed_stories = db.session.query(Story).filter(Story.date >= begin_date).filter(
-            Story.date <= end_date).filter(
-            Story.is_draft == False)
+        listed_stories = repository().in_range(begin_date, end_date)
 
         return jsonify([story.to_json() for story in listed_stories])
 
@@ -204,25 +277,23 @@ def _random_story():
     user_id = request.args.get('user_id')
     begin = (datetime.datetime.now() - datetime.timedelta(3)).date()
     if user_id and user_id.isdigit():
-        q = db.session.query(Story).filter(Story.date >= begin,
-                                           Story.author_id != user_id,
-                                           Story.is_draft == False)
+        story = repository().random_recent(begin, exclude_author=int(user_id))
     else:
-        q = db.session.query(Story).filter(Story.date >= begin, Story.is_draft == False)
-    recent_stories = q.all()
+        story = repository().random_recent(begin)
     # pick a random story from them
-    if len(recent_stories) == 0:
+    if story is None:
         abort(404, 'There are no recent stories by other users')
     else:
-        pos = randint(0, len(recent_stories) - 1)
-        return jsonify(recent_stories[pos].to_json())
+        return jsonify(story.to_json())
 
 
 @stories.operation('getDrafts')
 def _user_drafts():
     user_id = request.args.get('user_id')
-    if user_id and user_id.isdigit:
-        drafts = Story.query.filter_by(author_id=int(user_id), is_draft=True).all()
+    if user_id and user_id.isdigit():
+        if request.args.get('count_only', '').lower() in ('1', 'true'):
+            return jsonify(count=author_count(int(user_id), True))
+        drafts = author_timeline(int(user_id), True)
         if len(drafts) == 0:
             abort(404, 'There are no recent drafts by this user')
         else:
@@ -233,13 +304,13 @@ def _user_drafts():
 
 @stories.operation('getStoriesStatistics')
 def _stories_stats(user_id):
-    all_stories = Story.query.filter(Story.author_id == user_id).all()
-    num_stories = len(all_stories)
+    all_figures = repository().figures_of(user_id)
+    num_stories = len(all_figures)
     tot_num_dice = 0
     avg_dice = 0.0
 
-    for story in all_stories:
-        rolled_dice = story.figures.split('#')
+    for figures in all_figures:
+        rolled_dice = figures.split('#')
         rolled_dice = rolled_dice[1:-1]
         tot_num_dice += len(rolled_dice)
 
@@ -255,6 +326,37 @@ def _stories_stats(user_id):
     return jsonify(result)
 
 
+# Number of results asked with the k query parameter (at most TOP_CAPACITY)
+def top_k():
+    k = request.args.get('k', '10')
+    if not k.isdigit() or not 0 < int(k) <= TOP_CAPACITY:
+        abort(400, 'Invalid parameters')
+    return int(k)
+
+
+# Most used figures and pairs of figures, estimated from the sketches (see StoriesService.analytics)
+@stories.operation('getFiguresStatistics')
+def _figures_stats():
+    return jsonify(figures_summary(top_k()))
+
+
+# Statistics of a figure; the days are between begin and end ('yyyy-mm-dd', the last 30 days by default)
+@stories.operation('getFigureStatistics')
+def _figure_stats(figure):
+    k = top_k()
+    try:
+        today = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        end = request.args.get('end')
+        end_date = datetime.datetime.strptime(end, '%Y-%m-%d') if end else today
+        begin = request.args.get('begin')
+        begin_date = datetime.datetime.strptime(begin, '%Y-%m-%d') if begin else end_date - datetime.timedelta(29)
+    except ValueError:
+        abort(400, 'Invalid parameters')
+    if begin_date > end_date or (end_date - begin_date).days >= 366:
+        abort(400, 'Invalid parameters')
+    return jsonify(figure_details(figure, begin_date, end_date, k))
+
+
 # Return the result of the search in the story list
 @stories.operation('search')
 def _search():
@@ -271,7 +373,7 @@ def _search():
 
      # Check if there are user with the specified name or surname
     if query != '':
-        stories = Story.query.filter(and_(Story.figures.like('%#' + query + '#%'), Story.is_draft==False)).all()
+        stories = repository().search_figure(query)
 
     # Return the result of the search
     if len(stories) > 0:
@@ -0,0 +1,235 @@
+import datetime
+import json
+import math
+import os
+import random
+import tempfile
+import unittest
+from collections import Counter, defaultdict
+from itertools import combinations
+from threading import Thread, Barrier
+
+import flask_testing
+from unittest.mock import patch
+
+from StoriesService.analytics import CountMinSketch, HyperLogLog, TopK, FigureSketches, FIGURE_COUNTS, \
+    PAIR_COUNTS, DAY_COUNTS, TOP_FIGURES, TOP_PAIRS, AUTHORS, PAIR_CMS_WIDTH, PAIR_CMS_DEPTH, DAY_CMS_WIDTH, \
+    DAY_CMS_DEPTH, story_keys, exact_statistics, figures_summary
+from StoriesService.app import create_app
+from StoriesService.database import db, Story
+from StoriesService.tasks import figures_published
+from StoriesService.urls import *
+
+
+class TestSketches(unittest.TestCase):
+
+    # Zipf distributed figures, as the faces of a few popular dice sets
+    def stream(self, stories=5000, figures=200, authors=3000):
+        rng = random.Random(42)
+        weights = [1 / (rank + 1) for rank in range(figures)]
+        names = ['figure%d' % rank for rank in range(figures)]
+        start = datetime.datetime(2019, 1, 1)
+        for _ in range(stories):
+            yield rng.choices(names, weights, k=rng.randint(3, 6)), rng.randint(1, authors), \
+                start + datetime.timedelta(days=rng.randint(0, 60))
+
+    # Count-Min: never below the count, above it by more than the bound with probability e ** -depth
+    def assertErrors(self, cms, counts):
+        self.assertEqual(cms.total, sum(counts.values()))
+        bound = cms.error_bound()
+        errors = [cms.estimate(key) - count for key, count in counts.items()]
+        self.assertGreaterEqual(min(errors), 0)
+        self.assertLessEqual(sum(error > bound for error in errors), len(errors) * math.e ** -cms.depth)
+        return errors
+
+    def test_error_bounds(self):
+        # Sketches in memory, as built by rebuild_sketches
+        sketches = FigureSketches()
+        sketches.sketches.update({FIGURE_COUNTS: CountMinSketch(), TOP_FIGURES: TopK(), TOP_PAIRS: TopK(),
+                                  PAIR_COUNTS: CountMinSketch(PAIR_CMS_WIDTH, PAIR_CMS_DEPTH)})
+        counts, authors = Counter(), defaultdict(set)
+        for figures, author_id, date in self.stream():
+            for figure in figures:
+                sketches.sketches.setdefault(AUTHORS + figure, HyperLogLog())
+                authors[figure].add(author_id)
+            sketches.sketches.setdefault(DAY_COUNTS + date.strftime('%Y-%m-%d'),
+                                         CountMinSketch(DAY_CMS_WIDTH, DAY_CMS_DEPTH))
+            sketches.record(figures, author_id, date)
+            counts.update(story_keys(figures, date))
+
+        families = defaultdict(Counter)
+        for key, count in counts.items():
+            family, key = key.split(':', 1)
+            if family == 'day':
+                figure, day = key.rsplit(':', 1)
+                families[DAY_COUNTS + day][figure] = count
+            else:
+                families[family][key] = count
+        self.assertErrors(sketches[FIGURE_COUNTS], families['figure'])
+        self.assertErrors(sketches[PAIR_COUNTS], families['pair'])
+
+        # Pairs never rolled together are not reported: their estimates (collisions) are below the bound
+        pairs = sketches[PAIR_COUNTS]
+        unseen = [pair for pair in ('%s#%s' % pair for pair in combinations(sorted(authors), 2))
+                  if pair not in families['pair']]
+        self.assertLessEqual(sum(pairs.estimate(pair) > pairs.error_bound() for pair in unseen),
+                             len(unseen) * math.e ** -pairs.depth)
+
+        # Days: each has its own sketch, the daily counts (a few units) are almost always exact
+        errors = []
+        for name, day_counts in families.items():
+            if name.startswith(DAY_COUNTS):
+                errors += self.assertErrors(sketches[name], day_counts)
+                self.assertLessEqual(sketches[name].error_bound(), 5)
+        self.assertGreaterEqual(errors.count(0), 0.95 * len(errors))
+
+        # HyperLogLog: relative standard error 1.04 / sqrt(registers)
+        sigma = 1.04 / math.sqrt(len(HyperLogLog().registers))
+        relative = [abs(sketches.authors(figure).count() - len(exact)) / len(exact)
+                    for figure, exact in authors.items() if len(exact) >= 100]
+        self.assertLessEqual(sum(relative) / len(relative), sigma)
+        self.assertLessEqual(max(relative), 4 * sigma)
+
+        # Heavy hitters: the most used figures and pairs are found
+        self.assertEqual([figure for figure, _ in sketches[TOP_FIGURES].top(5)],
+                         [figure for figure, _ in families['figure'].most_common(5)])
+        self.assertLessEqual(set(pair for pair, _ in families['pair'].most_common(3)),
+                             set(pair for pair, _ in sketches[TOP_PAIRS].top(10)))
+
+    def test_serialization(self):
+        cms, hll = CountMinSketch(width=16, depth=2), HyperLogLog(precision=4)
+        cms.add('figure:cat', 3)
+        hll.add(1)
+        self.assertEqual(CountMinSketch.from_bytes(cms.to_bytes()).estimate('figure:cat'), 3)
+        self.assertEqual(CountMinSketch.from_bytes(cms.to_bytes()).total, 3)
+        self.assertEqual(HyperLogLog.from_bytes(hll.to_bytes()).count(), 1)
+
+
+class TestFigureStatistics(flask_testing.TestCase):
+    app = None
+
+    # First thing called
+    def create_app(self):
+        global app
+        app = create_app(database=TEST_DB, broker=TEST_BROKER)
+        return app
+
+    # Executed at end of each test
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+
+    def write(self, text, figures, user_id, as_draft=False):
+        payload = {'text': text, 'figures': figures, 'as_draft': as_draft, 'user_id': user_id}
+        with patch('StoriesService.views.stories.story_published'):
+            return self.client.post('/stories', data=json.dumps(payload), content_type='application/json')
+
+    def get(self, url):
+        response = self.client.get(url)
+        return response, json.loads(str(response.data, 'utf8'))
+
+    def test_published(self):
+        self.write('my cat and my dog', '#cat#dog#', 1)
+        self.write('the cat and the beer', '#cat#beer#', 2)
+        self.write('a cat, a cat and a dog', '#cat#cat#dog#', 2)
+        self.write('a draft on a cat', '#cat#', 3, as_draft=True)
+
+        response, body = self.get('/stats/figures')
+        self.assertStatus(response, 200)
+        self.assertEqual(body['figures'], [{'figure': 'cat', 'count': 4, 'authors': 2},
+                                           {'figure': 'dog', 'count': 2, 'authors': 2},
+                                           {'figure': 'beer', 'count': 1, 'authors': 1}])
+        self.assertEqual(body['pairs'], [{'figures': ['cat', 'dog'], 'count': 2},
+                                         {'figures': ['beer', 'cat'], 'count': 1}])
+        response, body = self.get('/stats/figures?k=1')
+        self.assertEqual(len(body['figures']), 1)
+
+        today = datetime.datetime.utcnow().strftime('%Y-%m-%d')
+        response, body = self.get('/stats/figures/dog?begin=' + today)
+        self.assertEqual(body['count'], 2)
+        self.assertEqual(body['days'], {today: 2})
+        self.assertEqual(body['with'], [{'figure': 'cat', 'count': 2}])
+
+        for url in ('/stats/figures?k=0', '/stats/figures?k=x', '/stats/figures/cat?begin=2019-01-01',
+                    '/stats/figures/cat?begin=2019-02-01&end=2019-01-01', '/stats/figures/cat?end=x'):
+            response, body = self.get(url)
+            self.assertStatus(response, 400)
+            self.assertEqual(body['description'], 'Invalid parameters')
+
+    def test_rebuild(self):
+        # Stories written without the views are not in the sketches until they are rebuilt
+        for author_id, figures in ((1, '#cat#dog#'), (2, '#cat#'), (2, '#moon#')):
+            story = Story()
+            story.text = 'A story'
+            story.figures = figures
+            story.author_id = author_id
+            story.is_draft = False
+            db.session.add(story)
+        db.session.commit()
+        self.assertEqual(figures_summary(10)['figures'], [])
+
+        result = app.test_cli_runner().invoke(args=['figures', '--rebuild'])
+        self.assertIn('cat', result.output)
+        counts, authors = exact_statistics()
+        self.assertEqual(counts['figure:cat'], 2)
+        self.assertEqual([(item['figure'], item['count'], item['authors']) for item in figures_summary(10)['figures']],
+                         [('cat', 2, 2), ('dog', 1, 1), ('moon', 1, 1)])
+
+
+class TestConcurrentPublications(flask_testing.TestCase):
+    app = None
+
+    # A database shared by the connections of all the threads (a file instead of the SQLite memory one)
+    def create_app(self):
+        global app
+        self.path = None
+        database = TEST_DB
+        if TEST_DB.endswith(':memory:'):
+            self.path = os.path.join(tempfile.mkdtemp(), 'stories.db')
+            database = 'sqlite:///' + self.path
+        app = create_app(database=database, broker=TEST_BROKER)
+        return app
+
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+        if self.path is not None:
+            os.remove(self.path)
+
+    def test_concurrent_publications(self):
+        n = 8
+        for author_id in range(1, n + 1):
+            story = Story()
+            story.text = 'A story'
+            story.figures = '#cat#dog#'
+            story.author_id = author_id
+            story.is_draft = False
+            db.session.add(story)
+        db.session.commit()
+        ids = [story.id for story in Story.query.all()]
+        # The sketch rows exist: concurrent updates of the same rows
+        figures_published(ids.pop(0))
+        db.session.remove()
+        barrier = Barrier(n - 1)
+        errors = []
+
+        def publish(story_id):
+            with app.app_context():
+                barrier.wait()
+                try:
+                    figures_published(story_id)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    db.session.remove()
+
+        threads = [Thread(target=publish, args=(story_id,)) for story_id in ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # No publication is lost
+        self.assertEqual(errors, [])
+        self.assertEqual([(item['figure'], item['count'], item['authors']) for item in figures_summary(10)['figures']],
+                         [('cat', n, n), ('dog', n, n)])
@@ -0,0 +1,123 @@
+import datetime
+import importlib.util
+import os
+import sys
+import tempfile
+
+import flask_testing
+from sqlalchemy import inspect
+from unittest.mock import patch
+
+from StoriesService.app import create_app
+from StoriesService.corpus import COLUMNS
+from StoriesService.database import db, Story, AuthorCounter, ArchivedStory, FeedVersion, RecentWrite, FigureSketch
+from StoriesService.urls import *
+
+FORMATS = ['csv'] + (['parquet', 'arrow'] if importlib.util.find_spec('pyarrow') else [])
+
+
+class TestCorpus(flask_testing.TestCase):
+    app = None
+
+    # First thing called
+    def create_app(self):
+        global app
+        app = create_app(database=TEST_DB, broker=TEST_BROKER)
+        return app
+
+    # Set up database for testing here
+    def setUp(self) -> None:
+        for author_id, text, is_draft, content_hash in ((1, 'A "quoted", story\nin two\tlines \\N', False, 'ab' * 32),
+                                                        (1, 'Una storia più lunga', True, None),
+                                                        (2, '', False, 'cd' * 32)):
+            story = Story()
+            story.text = text
+            story.figures = '#story#'
+            story.author_id = author_id
+            story.is_draft = is_draft
+            story.content_hash = content_hash
+            story.date = datetime.datetime(2019, 10, 20, 12, 30)
+            db.session.add(story)
+        archived = Story(id=10, text='An archived story', figures='#old#', author_id=2)
+        archived.date = datetime.datetime(2015, 1, 1)
+        db.session.add(ArchivedStory.from_story(archived))
+        db.session.commit()
+
+    # Executed at end of each test
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+
+    def rows(self):
+        return [tuple(getattr(story, column) for column in COLUMNS) for story in Story.query.order_by(Story.id)] + \
+               [(archived.id, archived.date, archived.figures, archived.author_id, archived.to_story().text)
+                for archived in ArchivedStory.query.order_by(ArchivedStory.id)]
+
+    def invoke(self, *args):
+        return app.test_cli_runner().invoke(args=list(args))
+
+    def test_round_trip(self):
+        expected = self.rows()
+        for fmt in FORMATS:
+            path = os.path.join(tempfile.mkdtemp(), 'stories.' + fmt)
+            result = self.invoke('export', path)
+            self.assertEqual(result.output.strip(), 'Exported 4 stories to %s' % path, fmt)
+
+            # Stale counters and feed version are rebuilt by the import, remembered writes and sketches emptied
+            db.session.query(AuthorCounter).delete()
+            db.session.add(RecentWrite(key='content:' + 'ab' * 32, story_id=1, status=201, description='Draft created'))
+            db.session.add(FigureSketch(name='figures', data=b''))
+            db.session.commit()
+            version = FeedVersion.query.get(1).version
+            result = self.invoke('import', path, '--replace', '--batch-size', '2')
+            self.assertIn('Imported 4 stories', result.output, fmt)
+            db.session.expire_all()
+            self.assertEqual(self.rows(), expected, fmt)
+            self.assertEqual([(c.author_id, c.num_stories, c.num_drafts) for c in AuthorCounter.query.order_by(
+                AuthorCounter.author_id)], [(1, 1, 1), (2, 2, 0)], fmt)
+            self.assertEqual(FeedVersion.query.get(1).version, version + 1)
+            self.assertEqual((RecentWrite.query.count(), FigureSketch.query.count()), (0, 0))
+
+        indexes = set(index['name'] for index in inspect(db.engine).get_indexes('story'))
+        self.assertLessEqual({'ix_story_author_draft_date', 'ix_story_content_hash'}, indexes)
+
+        # Ids continue after the imported and the archived ones
+        story = Story()
+        story.author_id = 3
+        db.session.add(story)
+        db.session.commit()
+        self.assertEqual(story.id, 11)
+
+    def test_not_empty(self):
+        path = os.path.join(tempfile.mkdtemp(), 'stories.csv')
+        self.invoke('export', path)
+        result = self.invoke('import', path)
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('The story table is not empty (use --replace)', result.output)
+        self.assertEqual(Story.query.count(), 3)
+
+    def test_archive_not_empty(self):
+        path = os.path.join(tempfile.mkdtemp(), 'stories.csv')
+        self.invoke('export', path)
+        db.session.query(Story).delete()
+        db.session.commit()
+        result = self.invoke('import', path)
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('The story table is not empty (use --replace)', result.output)
+
+    def test_without_archived_column(self):
+        # Files exported before the archive was: all the stories go to the story table
+        path = os.path.join(tempfile.mkdtemp(), 'stories.csv')
+        with open(path, 'w', encoding='utf8') as f:
+            f.write(','.join(COLUMNS) + '\n1,A story,2019-10-20T12:30:00,#story#,1,0,\n')
+        result = self.invoke('import', path, '--replace')
+        self.assertIn('Imported 1 stories', result.output)
+        self.assertEqual(self.rows(), [(1, 'A story', datetime.datetime(2019, 10, 20, 12, 30), '#story#', 1, False,
+                                        None)])
+
+    def test_without_pyarrow(self):
+        path = os.path.join(tempfile.mkdtemp(), 'stories.parquet')
+        with patch.dict(sys.modules, {'pyarrow': None, 'pyarrow.parquet': None}):
+            result = self.invoke('export', path)
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('pyarrow is needed for the parquet format, use csv', result.output)
@@ -0,0 +1,189 @@
+import json
+import os
+import tempfile
+from threading import Thread, Barrier
+
+import flask_testing
+from unittest.mock import Mock, patch
+
+from StoriesService.app import create_app
+from StoriesService.database import db, Story, RecentWrite
+from StoriesService.dedup import content_hash, recent_write
+from StoriesService.urls import *
+
+STORY = {'text': 'my cat is drinking a beer with my neighbour\'s dog', 'figures': '#beer#cat#dog#',
+         'as_draft': False, 'user_id': 1}
+
+
+class TestDedup(flask_testing.TestCase):
+    app = None
+
+    # First thing called
+    def create_app(self):
+        global app
+        app = create_app(database=TEST_DB, broker=TEST_BROKER)
+        return app
+
+    # Executed at end of each test
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+
+    def post(self, payload, **headers):
+        return self.client.post('/stories', data=json.dumps(payload), content_type='application/json',
+                                headers=headers)
+
+    def test_content_hash(self):
+        self.assertEqual(content_hash(1, '#a#', 'a  story\n', False), content_hash(1, '#a#', 'a story', False))
+        self.assertNotEqual(content_hash(1, '#a#', 'a story', False), content_hash(2, '#a#', 'a story', False))
+        self.assertNotEqual(content_hash(1, '#a#', 'a story', False), content_hash(1, '#b#', 'a story', False))
+        self.assertNotEqual(content_hash(1, '#a#', 'a story', False), content_hash(1, '#a#', 'a story', True))
+
+    def test_duplicate_content(self):
+        with patch('StoriesService.views.stories.story_published') as published:
+            response = self.post(STORY)
+            self.assertStatus(response, 201)
+            self.assertNotIn('Idempotent-Replayed', response.headers)
+
+            # Double click, with some extra spaces
+            response = self.post(dict(STORY, text=STORY['text'] + '  '))
+            body = json.loads(str(response.data, 'utf8'))
+            self.assertStatus(response, 201)
+            self.assertEqual(body['description'], 'New story has been published')
+            self.assertEqual(response.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(Story.query.count(), 1)
+        published.delay.assert_called_once_with(1)
+
+        # Same content by another author is a new story
+        response = self.post(dict(STORY, user_id=2))
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        self.assertEqual(Story.query.count(), 2)
+
+    def test_draft_then_published(self):
+        with patch('StoriesService.views.stories.story_published') as published:
+            self.assertStatus(self.post(dict(STORY, as_draft=True)), 201)
+            response = self.post(STORY)
+        body = json.loads(str(response.data, 'utf8'))
+        self.assertEqual(body['description'], 'New story has been published')
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        published.delay.assert_called_once_with(2)
+        response = self.client.get('/stories/users/1?count_only=true')
+        self.assertEqual(json.loads(str(response.data, 'utf8')), {'count': 1})
+
+    def test_deleted_then_written_again(self):
+        with patch('StoriesService.views.stories.story_published'):
+            self.post(STORY)
+            with patch('requests.delete', return_value=Mock(status_code=200)):
+                self.client.delete('/stories/1', data=json.dumps({'user_id': 1}), content_type='application/json')
+            self.assertEqual(RecentWrite.query.count(), 0)
+            response = self.post(STORY)
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        self.assertEqual([story.id for story in Story.query.all()], [2])
+
+        # Writes of stories deleted without the views are not replayed either
+        db.session.delete(Story.query.get(2))
+        db.session.commit()
+        with patch('StoriesService.views.stories.story_published'):
+            response = self.post(STORY)
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        self.assertEqual(Story.query.count(), 1)
+
+    def test_edited_then_written_again(self):
+        draft = dict(STORY, as_draft=True)
+        self.post(dict(draft, text='story A'))
+        self.client.put('/stories/1', data=json.dumps(dict(draft, text='story B', story_id=1)),
+                        content_type='application/json')
+
+        # The draft does not have that content anymore: writing it again is a new story
+        response = self.post(dict(draft, text='story A'))
+        self.assertStatus(response, 201)
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        self.assertEqual(sorted(story.text for story in Story.query.all()), ['story A', 'story B'])
+
+    def test_idempotency_key(self):
+        draft = dict(STORY, as_draft=True)
+        response = self.post(draft, **{'Idempotency-Key': 'abc'})
+        self.assertStatus(response, 201)
+
+        # A retry with the same key gets the original result, even if the body changed
+        response = self.post(dict(draft, text='something else'), **{'Idempotency-Key': 'abc'})
+        body = json.loads(str(response.data, 'utf8'))
+        self.assertStatus(response, 201)
+        self.assertEqual(body['description'], 'Draft created')
+        self.assertEqual(response.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(Story.query.count(), 1)
+
+        # Keys are per author
+        response = self.post(dict(draft, user_id=2), **{'Idempotency-Key': 'abc'})
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        self.assertEqual(Story.query.count(), 2)
+
+    def test_lost_race(self):
+        self.post(STORY)
+        # The duplicate is not seen before inserting (concurrent write), the unique key catches it
+        calls = []
+
+        def racing_check(keys, window):
+            calls.append(keys)
+            return recent_write(keys, window) if len(calls) > 1 else None
+
+        with patch('StoriesService.views.stories.recent_write', side_effect=racing_check):
+            response = self.post(STORY)
+        self.assertEqual(len(calls), 2)
+        self.assertStatus(response, 201)
+        self.assertEqual(response.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(Story.query.count(), 1)
+
+    def test_window(self):
+        self.post(STORY)
+        # Once out of the window, the same content can be published again
+        RecentWrite.query.update({'date': RecentWrite.date - app.config['DEDUP_WINDOW']})
+        db.session.commit()
+        response = self.post(STORY)
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        self.assertEqual(Story.query.count(), 2)
+        self.assertEqual(RecentWrite.query.count(), 1)
+
+
+class TestConcurrentDuplicates(flask_testing.TestCase):
+    app = None
+
+    # A database shared by the connections of all the threads (a file instead of the SQLite memory one)
+    def create_app(self):
+        global app
+        self.path = None
+        database = TEST_DB
+        if TEST_DB.endswith(':memory:'):
+            self.path = os.path.join(tempfile.mkdtemp(), 'stories.db')
+            database = 'sqlite:///' + self.path
+        app = create_app(database=database, broker=TEST_BROKER)
+        return app
+
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+        if self.path is not None:
+            os.remove(self.path)
+
+    def test_concurrent_duplicates(self):
+        n = 8
+        barrier = Barrier(n)
+        responses = []
+
+        def submit():
+            client = app.test_client()
+            barrier.wait()
+            responses.append(client.post('/stories', data=json.dumps(STORY), content_type='application/json',
+                                         headers={'Idempotency-Key': 'double-click'}))
+
+        with patch('StoriesService.views.stories.story_published') as published:
+            threads = [Thread(target=submit) for _ in range(n)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([response.status_code for response in responses], [201] * n)
+        self.assertEqual(len([r for r in responses if 'Idempotent-Replayed' not in r.headers]), 1)
+        self.assertEqual(Story.query.count(), 1)
+        published.delay.assert_called_once_with(Story.query.one().id)
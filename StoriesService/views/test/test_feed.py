@@ -0,0 +1,113 @@
+import datetime
+import gzip
+import json
+
+import flask_testing
+from unittest.mock import Mock, patch
+
+from StoriesService.app import create_app
+from StoriesService.archive import archive_stories
+from StoriesService.database import db, Story
+from StoriesService.feed import feed
+from StoriesService.urls import *
+
+
+class TestFeed(flask_testing.TestCase):
+    app = None
+
+    # First thing called
+    def create_app(self):
+        global app
+        app = create_app(database=TEST_DB, broker=TEST_BROKER, rate_limits={})
+        return app
+
+    # Set up database for testing here
+    def setUp(self) -> None:
+        for author_id, day, is_draft in ((1, 10, False), (2, 11, False), (2, 12, True)):
+            story = Story()
+            story.text = 'Story of %d' % author_id
+            story.figures = '#story#'
+            story.author_id = author_id
+            story.is_draft = is_draft
+            story.date = datetime.datetime(2019, 10, day)
+            db.session.add(story)
+        db.session.commit()
+
+    # Executed at end of each test
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+
+    def ids(self, url='/stories'):
+        return [story['id'] for story in json.loads(str(self.client.get(url).data, 'utf8'))]
+
+    def write(self, as_draft):
+        payload = {'text': 'my cat, %s' % as_draft, 'figures': '#cat#', 'as_draft': as_draft, 'user_id': '3'}
+        with patch('StoriesService.views.stories.story_published'):
+            return self.client.post('/stories', data=json.dumps(payload), content_type='application/json')
+
+    def test_encodings(self):
+        plain = self.client.get('/stories')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(plain.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual([story['id'] for story in json.loads(str(plain.data, 'utf8'))], [2, 1])
+
+        compressed = self.client.get('/stories', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed.data), plain.data)
+        self.assertNotEqual(compressed.headers['ETag'], plain.headers['ETag'])
+
+        refused = self.client.get('/stories', headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', refused.headers)
+
+    def test_etag(self):
+        response = self.client.get('/stories/latest')
+        etag = response.headers['ETag']
+        response = self.client.get('/stories/latest', headers={'If-None-Match': etag})
+        self.assertStatus(response, 304)
+        self.assertEqual(response.data, b'')
+
+        self.write(as_draft=False)
+        response = self.client.get('/stories/latest', headers={'If-None-Match': etag})
+        self.assertStatus(response, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_invalidation(self):
+        self.assertEqual(self.ids(), [2, 1])
+        self.assertEqual(self.ids('/stories/latest'), [2, 1])
+        snapshot = feed().snapshots['stories']
+
+        # Drafts don't change the feed: no rebuild
+        self.write(as_draft=True)
+        self.assertEqual(self.ids(), [2, 1])
+        self.assertIs(feed().snapshots['stories'], snapshot)
+
+        self.write(as_draft=False)
+        self.assertEqual(self.ids(), [5, 2, 1])
+        self.assertEqual(self.ids('/stories/latest'), [5, 2, 1])
+
+        # Publishing a draft
+        response = self.client.put('/stories/3', data=json.dumps({'text': 'Story of 2', 'as_draft': False,
+                                                                   'user_id': 2}), content_type='application/json')
+        self.assertStatus(response, 200)
+        self.assertEqual(self.ids(), [5, 3, 2, 1])
+
+        with patch('requests.delete', return_value=Mock(status_code=200)):
+            self.client.delete('/stories/5', data=json.dumps({'user_id': 3}), content_type='application/json')
+        self.assertEqual(self.ids(), [3, 2, 1])
+
+        # Writes outside of the views, and archived stories
+        db.session.delete(Story.query.get(1))
+        db.session.commit()
+        self.assertEqual(self.ids(), [3, 2])
+        archive_stories(datetime.datetime(2019, 10, 12))
+        self.assertEqual(self.ids(), [3])
+        self.assertEqual(self.ids('/stories/latest'), [3])
+
+    def test_disabled(self):
+        app.config['FEED_SNAPSHOTS'] = False
+        response = self.client.get('/stories', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertNotIn('ETag', response.headers)
+        self.assertEqual(self.ids(), [2, 1])
+        self.assertEqual(feed().snapshots, {})
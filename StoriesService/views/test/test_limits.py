@@ -0,0 +1,106 @@
+import json
+
+import flask_testing
+from redis.exceptions import ConnectionError
+from unittest.mock import Mock
+
+from StoriesService.app import create_app
+from StoriesService.database import db
+from StoriesService.limits import MemoryStorage, RedisStorage
+from StoriesService.urls import *
+
+
+class TestLimits(flask_testing.TestCase):
+    app = None
+
+    # First thing called
+    def create_app(self):
+        global app
+        app = create_app(database=TEST_DB, broker=TEST_BROKER, rate_limits={
+            'search': {'rate': 1, 'burst': 2},
+            'getRangeStories': {'concurrency': 1, 'retry_after': 3},
+        })
+        return app
+
+    # Executed at end of each test
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+
+    def test_rate_limit(self):
+        for _ in range(2):
+            response = self.client.get('/search?query=abc')
+            self.assertStatus(response, 204)
+
+        response = self.client.get('/search?query=abc')
+        body = json.loads(str(response.data, 'utf8'))
+        self.assertStatus(response, 429)
+        self.assertEqual(body['description'], 'Too many requests, slow down')
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+        # Buckets are per client
+        response = self.client.get('/search?query=abc', environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertStatus(response, 204)
+
+        # Operations without limits are not affected
+        for _ in range(5):
+            response = self.client.get('/stories')
+            self.assertStatus(response, 200)
+
+    def test_load_shedding(self):
+        limiter = app.extensions['limiter']
+        # An expensive query is already running
+        self.assertTrue(limiter.concurrency.acquire('getRangeStories', 1))
+        response = self.client.get('/stories/range')
+        body = json.loads(str(response.data, 'utf8'))
+        self.assertStatus(response, 503)
+        self.assertEqual(body['description'], 'Server is busy, try again later')
+        self.assertEqual(response.headers['Retry-After'], '3')
+
+        # Once it's done, requests are served again and release their slot
+        limiter.concurrency.release('getRangeStories')
+        response = self.client.get('/stories/range')
+        self.assertStatus(response, 200)
+        self.assertEqual(limiter.concurrency.in_flight('getRangeStories'), 0)
+
+    def test_redis_down(self):
+        client = Mock()
+        client.register_script.return_value.side_effect = ConnectionError('Error 111 connecting to localhost:6379')
+        app.extensions['limiter'].storage = RedisStorage(client)
+        # Requests are let through, the failure is logged
+        with self.assertLogs(app.logger, 'ERROR') as logs:
+            for _ in range(3):
+                response = self.client.get('/search?query=abc')
+                self.assertStatus(response, 204)
+        self.assertIn('Rate limit storage unavailable, search:127.0.0.1 allowed', logs.output[0])
+
+
+class TestStorage(flask_testing.TestCase):
+
+    def create_app(self):
+        return create_app(database=TEST_DB, broker=TEST_BROKER)
+
+    def test_memory_refill(self):
+        storage = MemoryStorage()
+        self.assertEqual(storage.take('k', 2, 1, now=100.0), 0)
+        self.assertEqual(storage.take('k', 2, 1, now=100.0), 0.5)
+        self.assertEqual(storage.take('k', 2, 1, now=100.25), 0.25)
+        self.assertEqual(storage.take('k', 2, 1, now=101.0), 0)
+
+        # Idle buckets (full again after burst / rate seconds) are dropped, at most every PRUNE_INTERVAL seconds
+        for client in range(100):
+            storage.take('client%d' % client, 2, 10, now=200.0)
+        self.assertEqual(len(storage), 100)
+        storage.take('k', 2, 1, now=210.0)
+        self.assertEqual(len(storage), 101)
+        self.assertEqual(storage.take('client0', 2, 10, now=261.0), 0)
+        self.assertEqual(len(storage), 1)
+
+    def test_redis(self):
+        client = Mock()
+        script = client.register_script.return_value
+        script.return_value = b'0.5'
+        storage = RedisStorage(client)
+        self.assertEqual(storage.take('search:127.0.0.1', 2, 10, now=100.0), 0.5)
+        client.register_script.assert_called_once_with(RedisStorage.SCRIPT)
+        script.assert_called_once_with(keys=['ratelimit:search:127.0.0.1'], args=[2, 10, 100.0])
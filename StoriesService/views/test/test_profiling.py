@@ -0,0 +1,134 @@
+import importlib.util
+import json
+import os
+import pstats
+import tempfile
+import unittest
+from collections import deque
+
+import flask_testing
+from itsdangerous import TimestampSigner
+from unittest.mock import patch
+
+from StoriesService.app import create_app
+from StoriesService.database import db
+from StoriesService.profiling import make_token
+from StoriesService.urls import *
+
+SECRET = {'PROFILING_SECRET': 'profiling secret'}
+
+
+class TestProfiling(flask_testing.TestCase):
+    app = None
+
+    # First thing called
+    def create_app(self):
+        global app
+        with patch.dict(os.environ, SECRET):
+            app = create_app(database=TEST_DB, broker=TEST_BROKER, profiling=True)
+        app.config['PROFILING_DIR'] = tempfile.mkdtemp()
+        return app
+
+    # Executed at end of each test
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+
+    def profiles(self, token=None):
+        return self.client.get('/admin/profiles', headers={'X-Profile-Token': token or make_token(app)})
+
+    def test_signed_request(self):
+        # Requests without token are not profiled and the responses are the usual ones
+        response = self.client.get('/stories')
+        self.assertEqual(json.loads(str(response.data, 'utf8')), [])
+        self.assertEqual(json.loads(str(self.profiles().data, 'utf8')), [])
+
+        self.client.get('/stories/latest', headers={'X-Profile-Token': 'forged'})
+        self.assertEqual(json.loads(str(self.profiles().data, 'utf8')), [])
+
+        response = self.client.get('/stories?x=1', headers={'X-Profile-Token': make_token(app)})
+        self.assertEqual(json.loads(str(response.data, 'utf8')), [])
+        profiles = json.loads(str(self.profiles().data, 'utf8'))
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0]['path'], '/stories?x=1')
+        self.assertEqual(profiles[0]['endpoint'], 'stories._stories')
+        self.assertEqual(profiles[0]['error'], False)
+
+        # The capture is a pstats file, in which the view can be found
+        path = os.path.join(app.config['PROFILING_DIR'], profiles[0]['name'])
+        functions = [function for _, _, function in pstats.Stats(path).stats]
+        self.assertIn('_stories', functions)
+
+        response = self.client.get('/admin/profiles/' + profiles[0]['name'],
+                                   headers={'X-Profile-Token': make_token(app)})
+        self.assertStatus(response, 200)
+        with open(path, 'rb') as f:
+            self.assertEqual(response.data, f.read())
+
+    @unittest.skipUnless(importlib.util.find_spec('pyinstrument'), 'pyinstrument is not installed')
+    def test_speedscope(self):
+        app.config['PROFILING_FORMAT'] = 'speedscope'
+        self.client.get('/stories/latest', headers={'X-Profile-Token': make_token(app)})
+        profiles = json.loads(str(self.profiles().data, 'utf8'))
+        self.assertTrue(profiles[0]['name'].endswith('.speedscope.json'))
+        with open(os.path.join(app.config['PROFILING_DIR'], profiles[0]['name'])) as f:
+            self.assertIn('speedscope', json.load(f)['$schema'])
+
+    def test_sampling(self):
+        app.config['PROFILING_SAMPLE_RATE'] = 1.0
+        for _ in range(3):
+            self.client.get('/stories/latest')
+        self.assertEqual(len(json.loads(str(self.profiles().data, 'utf8'))), 3)
+
+    def test_keep(self):
+        app.config['PROFILING_SAMPLE_RATE'] = 1.0
+        app.extensions['profiling'].captures = deque(maxlen=2)
+        for _ in range(5):
+            self.client.get('/stories/latest')
+        # Only the files of the listed captures are left
+        profiles = json.loads(str(self.profiles().data, 'utf8'))
+        self.assertEqual(sorted(os.listdir(app.config['PROFILING_DIR'])),
+                         sorted(profile['name'] for profile in profiles))
+        self.assertEqual(len(profiles), 2)
+
+    def test_admin(self):
+        response = self.profiles(token='forged')
+        body = json.loads(str(response.data, 'utf8'))
+        self.assertStatus(response, 403)
+        self.assertEqual(body['description'], 'Invalid profiling token')
+
+        # Tokens signed with the SECRET_KEY of the app are not valid
+        token = TimestampSigner(app.config['SECRET_KEY'], salt='stories-profiling').sign('profile').decode('utf8')
+        self.assertStatus(self.profiles(token=token), 403)
+
+        response = self.client.get('/admin/profiles/../../etc/passwd', headers={'X-Profile-Token': make_token(app)})
+        self.assertStatus(response, 404)
+
+        result = app.test_cli_runner().invoke(args=['profile-token'])
+        self.assertStatus(self.profiles(token=result.output.strip()), 200)
+
+
+class TestProfilingDisabled(flask_testing.TestCase):
+
+    def create_app(self):
+        with patch.dict(os.environ, SECRET):
+            return create_app(database=TEST_DB, broker=TEST_BROKER)
+
+    def test_disabled(self):
+        # No hook installed
+        profiling = self.app.extensions['profiling']
+        hooks = self.app.before_request_funcs[None] + self.app.teardown_request_funcs[None]
+        self.assertEqual([hook for hook in hooks if getattr(hook, '__self__', None) is profiling], [])
+        response = self.client.get('/admin/profiles', headers={'X-Profile-Token': make_token(self.app)})
+        body = json.loads(str(response.data, 'utf8'))
+        self.assertStatus(response, 404)
+        self.assertEqual(body['description'], 'Profiling is disabled')
+
+    def test_secret_required(self):
+        with patch.dict(os.environ):
+            os.environ.pop('PROFILING_SECRET', None)
+            with self.assertRaisesRegex(RuntimeError, 'PROFILING_SECRET is not set'):
+                create_app(database=TEST_DB, broker=TEST_BROKER, profiling=True)
+            result = create_app(database=TEST_DB, broker=TEST_BROKER).test_cli_runner().invoke(args=['profile-token'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('PROFILING_SECRET is not set', result.output)
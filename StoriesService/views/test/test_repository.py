@@ -0,0 +1,73 @@
+import datetime
+import unittest
+
+import flask_testing
+from unittest.mock import patch
+
+from StoriesService.app import create_app
+from StoriesService.database import db, Story
+from StoriesService.repository import repository, StoryRepository, PostgresStoryRepository
+from StoriesService.urls import *
+
+
+class TestRepository(flask_testing.TestCase):
+    app = None
+
+    # First thing called
+    def create_app(self):
+        global app
+        app = create_app(database=TEST_DB, broker=TEST_BROKER)
+        return app
+
+    # Set up database for testing here
+    def setUp(self) -> None:
+        now = datetime.datetime.now().replace(second=0, microsecond=0)
+        for author_id, days, is_draft in ((1, 1, False), (1, 2, False), (2, 5, False), (2, 0, True),
+                                          (3, 2, False), (3, 1, False), (4, 0, False)):
+            story = Story()
+            story.text = 'Story of %d' % author_id
+            story.figures = '#story#'
+            story.author_id = author_id
+            story.is_draft = is_draft
+            story.date = now - datetime.timedelta(days)
+            db.session.add(story)
+        db.session.commit()
+
+    # Executed at end of each test
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+
+    # Repository of the dialect and the portable one
+    def repositories(self):
+        return [repository(), StoryRepository()]
+
+    def test_latest_per_author(self):
+        for repo in self.repositories():
+            self.assertEqual([story.id for story in repo.latest_per_author()], [7, 6, 1, 3], repo)
+
+    def test_latest_same_minute(self):
+        story = Story()
+        story.text = 'Second story of the minute'
+        story.figures = '#story#'
+        story.author_id = 4
+        story.is_draft = False
+        story.date = Story.query.get(7).date
+        db.session.add(story)
+        db.session.commit()
+        for repo in self.repositories():
+            self.assertEqual(repo.latest_per_author()[0].id, story.id, repo)
+
+    def test_random_recent(self):
+        since = datetime.datetime.now() - datetime.timedelta(3)
+        for repo in self.repositories():
+            seen = set(repo.random_recent(since, exclude_author=1).id for _ in range(50))
+            self.assertEqual(seen, {5, 6, 7}, repo)
+            self.assertEqual(repo.random_recent(datetime.datetime.now() + datetime.timedelta(1)), None)
+
+    @unittest.skipUnless(TEST_DB.startswith('postgresql'), 'TABLESAMPLE is PostgreSQL only')
+    def test_random_sample(self):
+        since = datetime.datetime.now() - datetime.timedelta(3)
+        with patch.multiple(PostgresStoryRepository, SAMPLE_MIN_ROWS=1, SAMPLE_ROWS=10 ** 6):
+            seen = set(repository().random_recent(since, exclude_author=1).id for _ in range(50))
+        self.assertEqual(seen, {5, 6, 7})
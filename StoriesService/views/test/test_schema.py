@@ -0,0 +1,79 @@
+import datetime
+import json
+import os
+import tempfile
+
+import flask_testing
+from sqlalchemy import create_engine, inspect, MetaData, Table, Column, Integer, Text, DateTime, Unicode, Boolean
+
+from StoriesService.app import create_app
+from StoriesService.database import db, Story, AuthorCounter
+from StoriesService.urls import *
+
+
+class TestSchemaUpgrade(flask_testing.TestCase):
+    app = None
+
+    # The story table as created by the first version of the service, with a story in it
+    def create_app(self):
+        global app
+        self.path = None
+        database = TEST_DB
+        if TEST_DB.endswith(':memory:'):
+            self.path = os.path.join(tempfile.mkdtemp(), 'stories.db')
+            database = 'sqlite:///' + self.path
+        engine = create_engine(database)
+        metadata = MetaData()
+        story = Table('story', metadata,
+                      Column('id', Integer, primary_key=True, autoincrement=True),
+                      Column('text', Text),
+                      Column('date', DateTime),
+                      Column('figures', Unicode(128)),
+                      Column('author_id', Integer),
+                      Column('is_draft', Boolean, default=True))
+        metadata.drop_all(engine)
+        metadata.create_all(engine)
+        engine.execute(story.insert().values(text='An old story', date=datetime.datetime(2019, 10, 20, 12, 30),
+                                             figures='#old#', author_id=1, is_draft=False))
+        engine.dispose()
+        app = create_app(database=database, broker=TEST_BROKER)
+        return app
+
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+        if self.path is not None:
+            os.remove(self.path)
+
+    def test_upgrade(self):
+        inspector = inspect(db.engine)
+        self.assertIn('content_hash', [column['name'] for column in inspector.get_columns('story')])
+        self.assertIn('ix_story_content_hash', set(index['name'] for index in inspector.get_indexes('story')))
+
+        response = self.client.get('/stories/1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(str(response.data, 'utf8'))['text'], 'An old story')
+
+        # Nothing left to do the second time
+        create_app(database=str(db.engine.url), broker=TEST_BROKER)
+        self.assertEqual(Story.query.count(), 1)
+
+    def test_author_timelines(self):
+        # The timeline index is added, the counters are computed from the stories written before they existed
+        indexes = set(index['name'] for index in inspect(db.engine).get_indexes('story'))
+        self.assertIn('ix_story_author_draft_date', indexes)
+        response = self.client.get('/stories/users/1?count_only=true')
+        self.assertEqual(json.loads(str(response.data, 'utf8')), {'count': 1})
+        db.session.delete(Story.query.get(1))
+        db.session.commit()
+        self.assertEqual(AuthorCounter.query.get(1).num_stories, 0)
+
+    def test_ids_not_reused(self):
+        # The SQLite story table is rebuilt with AUTOINCREMENT: ids of deleted stories are not reused
+        db.session.delete(Story.query.get(1))
+        db.session.commit()
+        story = Story()
+        story.author_id = 2
+        db.session.add(story)
+        db.session.commit()
+        self.assertEqual(story.id, 2)
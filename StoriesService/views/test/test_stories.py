@@ -3,10 +3,13 @@ import json
 
 import flask_testing
 from flask import jsonify
+from kombu.exceptions import OperationalError
 from unittest.mock import Mock, patch
 
 from StoriesService.app import create_app
-from StoriesService.database import db, Story
+from StoriesService.archive import archive_stories
+from StoriesService.database import db, Story, AuthorCounter, ArchivedStory
+from StoriesService.tasks import NEW_REACTIONS_URL
 from StoriesService.urls import *
 
 from StoriesService.views.test.mock import start_mock_server, get_free_port
@@ -18,7 +21,7 @@ class TestStories(flask_testing.TestCase):
     # First thing called
     def create_app(self):
         global app
-        app = create_app(database=TEST_DB)
+        app = create_app(database=TEST_DB, broker=TEST_BROKER)
         return app
 
     # Set up database for testing here
@@ -241,6 +244,138 @@ class TestStories(flask_testing.TestCase):
         self.assertStatus(response, 400)
         self.assertEqual(body['description'], 'Invalid parameters')
 
+    def test_stories_user_timeline(self):
+        # Newest story first, limited to one
+        response = self.client.get('/stories/users/2?limit=1')
+        body = json.loads(str(response.data, 'utf8'))
+        self.assertStatus(response, 200)
+        self.assertEqual([story['id'] for story in body], [3])
+
+        # Cursor: stories older than the given datetime
+        response = self.client.get('/stories/users/2?before=2019-10-13T00:00:00')
+        body = json.loads(str(response.data, 'utf8'))
+        self.assertStatus(response, 200)
+        self.assertEqual([story['id'] for story in body], [2])
+
+        # Counts only, drafts are not counted among the stories
+        response = self.client.get('/stories/users/3?count_only=true')
+        body = json.loads(str(response.data, 'utf8'))
+        self.assertStatus(response, 200)
+        self.assertEqual(body, {'count': 1})
+        response = self.client.get('/stories/users/50?count_only=true')
+        body = json.loads(str(response.data, 'utf8'))
+        self.assertEqual(body, {'count': 0})
+
+        # Invalid parameters
+        for url in ('/stories/users/abc', '/stories/users/2?limit=0', '/stories/users/2?limit=a',
+                    '/stories/users/2?before=yesterday', '/stories/users/2?before_id=3',
+                    '/stories/users/2?before=2019-10-13T00:00:00&before_id=a'):
+            response = self.client.get(url)
+            body = json.loads(str(response.data, 'utf8'))
+            self.assertStatus(response, 400)
+            self.assertEqual(body['description'], 'Invalid parameters')
+
+    def test_timeline_same_minute(self):
+        date = datetime.datetime(2019, 10, 15, 10, 30)
+        ids = []
+        for text in ('First of the minute', 'Second of the minute', 'Archived'):
+            story = Story()
+            story.text = text
+            story.author_id = 9
+            story.figures = '#minute#'
+            story.is_draft = False
+            story.date = date
+            ids.append(story)
+        for story in ids[:2]:
+            db.session.add(story)
+            db.session.commit()
+        ids[2].id = 1000
+        db.session.add(ArchivedStory.from_story(ids[2]))
+        db.session.commit()
+        ids = [story.id for story in ids]
+
+        # Pages of one story: the cursor is the date and the id of the last one
+        seen = []
+        url = '/stories/users/9?limit=1'
+        while True:
+            response = self.client.get(url)
+            if response.status_code == 404:
+                break
+            body = json.loads(str(response.data, 'utf8'))
+            seen.append(body[0]['id'])
+            url = '/stories/users/9?limit=1&before=%s&before_id=%d' % (date.isoformat(), body[0]['id'])
+        self.assertEqual(seen, [ids[2], ids[1], ids[0]])
+
+    def test_author_counters(self):
+        response = self.client.get('/stories/drafts?user_id=3&count_only=1')
+        body = json.loads(str(response.data, 'utf8'))
+        self.assertStatus(response, 200)
+        self.assertEqual(body, {'count': 1})
+
+        response = self.client.get('/stories/drafts?user_id=abc')
+        body = json.loads(str(response.data, 'utf8'))
+        self.assertStatus(response, 400)
+        self.assertEqual(body['description'], 'Invalid parameters')
+
+        # Publishing the draft moves it from the drafts counter to the stories counter
+        draft = Story.query.get(4)
+        draft.is_draft = False
+        db.session.commit()
+        self.assertEqual(AuthorCounter.query.get(3).num_drafts, 0)
+        self.assertEqual(AuthorCounter.query.get(3).num_stories, 2)
+
+        # Deleting a story decrements the counter
+        db.session.delete(Story.query.get(5))
+        db.session.commit()
+        self.assertEqual(AuthorCounter.query.get(3).num_stories, 1)
+
+        # Stories without author (written without the views) have no counter
+        story = Story()
+        story.text = 'anonymous'
+        story.is_draft = False
+        db.session.add(story)
+        db.session.commit()
+        story.is_draft = True
+        db.session.commit()
+        db.session.delete(story)
+        db.session.commit()
+        self.assertEqual(AuthorCounter.query.filter(AuthorCounter.author_id == None).count(), 0)
+
+    def test_archive(self):
+        very_old = {'author_id': 3, 'date': 'Fri, 11 Nov 2011 00:00:00 GMT', 'figures': '#example#nini#', 'id': 5,
+                    'is_draft': False, 'text': 'very old story (11 11 2011)'}
+        self.assertEqual(archive_stories(datetime.datetime(2015, 1, 1)), 1)
+        self.assertEqual(Story.query.get(5), None)
+        self.assertEqual(ArchivedStory.query.get(5).author_id, 3)
+
+        # Archived stories are still found by id, range, author and in the statistics
+        response = self.client.get('/stories/5')
+        self.assertStatus(response, 200)
+        self.assertEqual(json.loads(str(response.data, 'utf8')), very_old)
+
+        response = self.client.get('/stories/range?end=2013-10-10')
+        self.assertEqual(json.loads(str(response.data, 'utf8')), [very_old])
+
+        response = self.client.get('/stories/users/3')
+        self.assertEqual(json.loads(str(response.data, 'utf8')), [very_old])
+        response = self.client.get('/stories/users/3?count_only=1')
+        self.assertEqual(json.loads(str(response.data, 'utf8')), {'count': 1})
+
+        response = self.client.get('/stories/stats/3')
+        self.assertEqual(json.loads(str(response.data, 'utf8')), {'num_stories': 2, 'tot_num_dice': 4, 'avg_dice': 2.0})
+
+        # Drafts are never archived, new stories don't reuse archived ids
+        result = app.test_cli_runner().invoke(args=['archive', '--days', '0'])
+        self.assertEqual(result.output, 'Archived 3 stories older than %s\n' % datetime.date.today())
+        self.assertEqual(Story.query.get(4).is_draft, True)
+        story = Story()
+        story.text = 'new'
+        story.author_id = 1
+        story.figures = '#new#'
+        db.session.add(story)
+        db.session.commit()
+        self.assertEqual(story.id, 6)
+
     @classmethod
     def setup_class(cls):
         cls.mock_server_port = 5004
@@ -249,7 +384,7 @@ class TestStories(flask_testing.TestCase):
     def test_write_story(self):
         mock_users_url = 'http://localhost:{port}/new'.format(port=self.mock_server_port)
         # Testing publishing valid story
-        with patch.dict('StoriesService.views.stories.__dict__', {'NEW_REACTIONS_URL': mock_users_url}):
+        with patch.dict('StoriesService.tasks.__dict__', {'NEW_REACTIONS_URL': mock_users_url}):
             payload = {'text': 'my cat is drinking a beer with my neighbour\'s dog', 'figures': '#beer#cat#dog#',
                        'as_draft': False, 'user_id': '1'}
             response = self.client.post('/stories', data=json.dumps(payload), content_type='application/json')
@@ -266,6 +401,14 @@ class TestStories(flask_testing.TestCase):
         self.assertStatus(response, 400)
         self.assertEqual(body['description'], 'Wrong parameters')
 
+        # Null user id
+        payload = {'text': 'my cat is drinking a gin tonic with my neighbour\'s dog', 'figures': '#cat#dog#',
+                   'as_draft': True, 'user_id': None}
+        response = self.client.post('/stories', data=json.dumps(payload), content_type='application/json')
+        body = json.loads(str(response.data, 'utf8'))
+        self.assertStatus(response, 400)
+        self.assertEqual(body['description'], 'Wrong parameters')
+
         # Testing publishing invalid story
         payload = {'text': 'my cat is drinking a gin tonic with my neighbour\'s dog', 'figures': '#beer#cat#dog#',
                    'as_draft': False, 'user_id': '1'}
@@ -339,6 +482,37 @@ class TestStories(flask_testing.TestCase):
         body = json.loads(str(response.data, 'utf8'))
         self.assertStatus(response, 400)
         self.assertEqual(body['description'], 'Errors in request body')
+        payload3 = {'text': 'my cat is drinking dog and beer', 'as_draft': True, 'user_id': None}
+        response = self.client.put('/stories/4', data=json.dumps(payload3), content_type='application/json')
+        self.assertStatus(response, 400)
+
+    def test_publish_reactions_down(self):
+        # The story is published even if ReactionService fails, the notification is retried in background
+        with patch('StoriesService.tasks.requests.post', return_value=Mock(status_code=500)) as post:
+            payload = {'text': 'my cat is drinking a beer with my neighbour\'s dog', 'figures': '#beer#cat#dog#',
+                       'as_draft': False, 'user_id': '1'}
+            response = self.client.post('/stories', data=json.dumps(payload), content_type='application/json')
+        body = json.loads(str(response.data, 'utf8'))
+        self.assertStatus(response, 201)
+        self.assertEqual(body['description'], 'New story has been published')
+        self.assertEqual(post.call_count, 6)
+        post.assert_called_with(NEW_REACTIONS_URL, json={'story_id': 6})
+        self.assertEqual(Story.query.get(6).is_draft, False)
+
+    def test_publish_broker_down(self):
+        # The story is committed before its tasks are queued: the request succeeds, the failure is logged
+        with patch('StoriesService.views.stories.story_published') as published, \
+                patch('StoriesService.views.stories.figures_published') as figures, \
+                self.assertLogs(app.logger, 'ERROR') as logs:
+            published.name = 'story_published'
+            published.delay.side_effect = OperationalError('Error 111 connecting to localhost:6379')
+            payload = {'text': 'my cat is drinking a beer with my neighbour\'s dog', 'figures': '#beer#cat#dog#',
+                       'as_draft': False, 'user_id': '1'}
+            response = self.client.post('/stories', data=json.dumps(payload), content_type='application/json')
+        self.assertStatus(response, 201)
+        self.assertEqual(Story.query.get(6).is_draft, False)
+        figures.delay.assert_called_once_with(6)
+        self.assertIn('Could not queue story_published for story 6', logs.output[0])
 
     def test_delete_story(self):
         # Deleting the story of another user
@@ -349,6 +523,12 @@ class TestStories(flask_testing.TestCase):
         self.assertEqual(body['description'],
                          'Request is invalid, check if you are the author of the story and the id is a valid one')
 
+        # Deleting a story that does not exist
+        response = self.client.delete('/stories/50', data=json.dumps({'user_id': 3}), content_type='application/json')
+        body = json.loads(str(response.data, 'utf8'))
+        self.assertStatus(response, 404)
+        self.assertEqual(body['description'], 'Specified story not found')
+
         # Deleting your story
         mock_users_url = 'http://localhost:{port}/delete'.format(port=self.mock_server_port)
         #Testing deleting valid story
@@ -360,6 +540,16 @@ class TestStories(flask_testing.TestCase):
         self.assertEqual(body['description'],
                          'Story has been deleted')
 
+        # Deleting your archived story
+        archive_stories(datetime.datetime(2012, 1, 1))
+        with patch.dict('StoriesService.views.stories.__dict__', {'DELETE_REACTIONS_URL': mock_users_url}):
+            response = self.client.delete('/stories/5', data=json.dumps({'user_id': 3}),
+                                          content_type='application/json')
+        self.assertStatus(response, 200)
+        self.assertEqual(ArchivedStory.query.get(5), None)
+        self.assertEqual((AuthorCounter.query.get(3).num_stories, AuthorCounter.query.get(3).num_drafts), (0, 1))
+        self.assertStatus(self.client.get('/stories/5'), 404)
+
     def test_search_exist(self):
         response = self.client.get('/search?query=nini')
         body = json.loads(str(response.data, 'utf8'))
@@ -407,7 +597,7 @@ class TestRandomRecentStory(flask_testing.TestCase):
     # First thing called
     def create_app(self):
         global app
-        app = create_app(database=TEST_DB)
+        app = create_app(database=TEST_DB, broker=TEST_BROKER)
         return app
 
     # Set up database for testing here
@@ -443,6 +633,11 @@ class TestRandomRecentStory(flask_testing.TestCase):
             db.session.add(example)
             db.session.commit()
 
+    # Executed at end of each test
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+
     def test_random_recent_story(self):
         # Random recent story as anonymous user
         response = self.client.get('/stories/random')
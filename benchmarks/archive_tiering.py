@@ -0,0 +1,84 @@
+# Hot table size, archive size and query latency before and after archiving.
+#
+#   python -m benchmarks.archive_tiering [stories] [archive after days]
+import datetime
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from StoriesService.app import create_app
+from StoriesService.archive import archive_stories
+from StoriesService.database import db, Story
+from StoriesService.urls import TEST_BROKER
+
+WORDS = ('cat dog beer moon dice story king queen dragon sword castle river tree book magic night day '
+         'rain sun star sea ship island forest bird snake wolf bear door key').split()
+
+
+def populate(n, years=10):
+    now = datetime.datetime.now()
+    rows = []
+    for i in range(n):
+        figures = random.sample(WORDS, 4)
+        text = ' '.join(random.choice(WORDS) for _ in range(150)) + ' ' + ' '.join(figures)
+        rows.append({'text': text, 'figures': '#' + '#'.join(figures) + '#', 'author_id': random.randint(1, 500),
+                     'is_draft': False, 'date': now - datetime.timedelta(minutes=random.randint(0, years * 525600))})
+        if len(rows) == 5000:
+            db.session.execute(Story.__table__.insert(), rows)
+            rows = []
+    if rows:
+        db.session.execute(Story.__table__.insert(), rows)
+    db.session.commit()
+
+
+def table_size(*tables):
+    # Pages of the tables and of their indexes
+    names = ','.join("'%s'" % table for table in tables)
+    return db.session.execute(
+        "SELECT coalesce(sum(pgsize), 0) FROM dbstat WHERE name IN (%s) OR name IN "
+        "(SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name IN (%s))" % (names, names)).scalar()
+
+
+def latency(client, url, runs=20):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        response = client.get(url)
+        timings.append((time.perf_counter() - start) * 1000)
+        assert response.status_code < 400, (url, response.status_code)
+    return statistics.median(timings)
+
+
+def report(client, label, old_id):
+    last_month = (datetime.date.today() - datetime.timedelta(30)).isoformat()
+    print('%s: hot %.1f MB, archive %.1f MB' % (
+        label, table_size('story') / 2 ** 20, table_size('story_archive') / 2 ** 20))
+    for url in ('/stories/range?begin=' + last_month, '/search?query=dragon', '/stories/random',
+                '/stories/%d' % old_id, '/stories/range?begin=2000-01-01&end=' + last_month):
+        print('  %-55s %9.2f ms' % (url, latency(client, url, runs=5 if 'end=' in url else 20)))
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 365
+    path = os.path.join(tempfile.mkdtemp(), 'stories.db')
+    flask_app = create_app(database='sqlite:///' + path, broker=TEST_BROKER, rate_limits={})
+    client = flask_app.test_client()
+    with flask_app.app_context():
+        populate(n)
+        old_id = Story.query.filter(Story.date < datetime.datetime.now() - datetime.timedelta(days * 2)).first().id
+        print('%d stories, archiving the ones older than %d days' % (n, days))
+        report(client, 'before', old_id)
+
+        start = time.perf_counter()
+        moved = archive_stories(datetime.datetime.now() - datetime.timedelta(days))
+        print('archived %d stories in %.1f s' % (moved, time.perf_counter() - start))
+        db.session.execute('VACUUM')
+        report(client, 'after', old_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# Export and import of the story table (flask export / flask import) in each format: rows/sec and peak RSS.
+# Every operation runs in its own process, so that its peak RSS can be measured; `to_json` is the
+# dump through Story.to_json (as GET /stories does), for comparison.
+# SQLite (a temporary file) by default, STORIES_BENCH_DB selects another database (it is emptied!).
+#
+#   python -m benchmarks.corpus_transfer [stories]
+import datetime
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from StoriesService.app import create_app
+from StoriesService.corpus import export_stories, import_stories
+from StoriesService.database import db, Story
+from StoriesService.urls import BENCH_DB, TEST_BROKER
+
+WORDS = 'my cat is drinking a beer with the dog of my neighbour under the moon while the bird sings'.split()
+
+
+def populate(n):
+    now = datetime.datetime.now()
+    for start in range(0, n, 10000):
+        rows = [{'text': ' '.join(random.choices(WORDS, k=40)), 'figures': '#beer#cat#dog#moon#bird#',
+                 'author_id': random.randint(1, 20000), 'is_draft': random.random() < 0.1,
+                 'content_hash': '%064x' % random.getrandbits(256),
+                 'date': now - datetime.timedelta(minutes=random.randint(0, 365 * 1440))}
+                for _ in range(start, min(n, start + 10000))]
+        db.session.execute(Story.__table__.insert(), rows)
+    db.session.commit()
+
+
+# High water mark of this process (ru_maxrss would include the memory of the parent before exec)
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('VmHWM')) / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Child process: runs a single operation and prints its measures
+def step(database, operation, fmt, path):
+    flask_app = create_app(database=database, broker=TEST_BROKER)
+    with flask_app.app_context():
+        db.session.execute('SELECT 1')
+        baseline = peak_rss_mb()
+        start = time.perf_counter()
+        if operation == 'export':
+            rows = export_stories(path, fmt)
+        elif operation == 'import':
+            rows = import_stories(path, fmt, replace=True)
+        else:
+            stories = [story.to_json() for story in Story.query.all()]
+            with open(path, 'w') as f:
+                json.dump(stories, f, default=str)
+            rows = len(stories)
+        seconds = time.perf_counter() - start
+        print(json.dumps({'rows': rows, 'seconds': seconds, 'baseline': baseline, 'peak': peak_rss_mb()}))
+
+
+def run(database, operation, fmt, path):
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.corpus_transfer', '--step', database, operation,
+                             fmt, path], check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    directory = tempfile.mkdtemp()
+    database = BENCH_DB or 'sqlite:///' + os.path.join(directory, 'stories.db')
+    flask_app = create_app(database=database, broker=TEST_BROKER)
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        populate(n)
+        dialect = db.engine.dialect.name
+        db.session.remove()
+
+    print('%s, %d stories: rows/sec, peak RSS (process baseline), file size' % (dialect, n))
+    measures = [('to_json', 'json')] + [(operation, fmt) for fmt in ('parquet', 'arrow', 'csv')
+                                        for operation in ('export', 'import')]
+    for operation, fmt in measures:
+        path = os.path.join(directory, 'stories.' + fmt)
+        result = run(database, operation, fmt, path)
+        print('  %-8s %-8s %10.0f rows/s %8.0f MB (%3.0f MB) %8.0f MB' % (
+            operation, fmt, result['rows'] / result['seconds'], result['peak'], result['baseline'],
+            os.path.getsize(path) / 2 ** 20))
+
+    with flask_app.app_context():
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--step']:
+        step(*sys.argv[2:6])
+    else:
+        main()
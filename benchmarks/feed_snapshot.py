@@ -0,0 +1,88 @@
+# Feed responses (GET /stories, /stories/latest) served from the snapshots vs built from SQL on each request.
+# SQLite (a temporary file) by default, STORIES_BENCH_DB selects another database (it is emptied!).
+#
+#   python -m benchmarks.feed_snapshot [stories]
+import datetime
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from StoriesService.app import create_app
+from StoriesService.database import db, Story
+from StoriesService.feed import feed
+from StoriesService.urls import BENCH_DB, TEST_BROKER
+
+
+def populate(n, authors=1000, days=60):
+    now = datetime.datetime.now()
+    rows = [{'text': 'my cat is drinking a beer with the dog of my neighbour, story %d' % i,
+             'figures': '#beer#cat#dog#', 'author_id': random.randint(1, authors), 'is_draft': random.random() < 0.1,
+             'date': now - datetime.timedelta(minutes=random.randint(0, days * 1440))} for i in range(n)]
+    for start in range(0, n, 5000):
+        db.session.execute(Story.__table__.insert(), rows[start:start + 5000])
+    db.session.commit()
+
+
+def timed(client, url, headers, runs=20, warmup=3):
+    for _ in range(warmup):
+        client.get(url, headers=headers)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        response = client.get(url, headers=headers)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), len(response.data)
+
+
+# Time spent in the view only (version lookup, encoding negotiation, response), without the WSGI round trip
+def timed_view(flask_app, url, runs=200):
+    with flask_app.test_request_context(url, headers={'Accept-Encoding': 'gzip'}):
+        name = 'stories' if url == '/stories' else 'latest'
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            feed().response(name, None)
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    database = BENCH_DB or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'stories.db')
+    flask_app = create_app(database=database, broker=TEST_BROKER, rate_limits={})
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        populate(n)
+        dialect = db.engine.dialect.name
+    client = flask_app.test_client()
+    print('%s, %d stories: median of a request (test client), response size' % (dialect, n))
+    for url in ('/stories', '/stories/latest'):
+        flask_app.config['FEED_SNAPSHOTS'] = False
+        sql, sql_size = timed(client, url, {}, runs=5)
+        flask_app.config['FEED_SNAPSHOTS'] = True
+        start = time.perf_counter()
+        client.get(url)
+        rebuild = (time.perf_counter() - start) * 1000
+        plain, plain_size = timed(client, url, {})
+        gzipped, gzip_size = timed(client, url, {'Accept-Encoding': 'gzip'})
+        etag = client.get(url).headers['ETag']
+        not_modified, _ = timed(client, url, {'If-None-Match': etag})
+        view = timed_view(flask_app, url)
+        print('  %s' % url)
+        print('    from SQL           %9.2f ms %9d B' % (sql, sql_size))
+        print('    rebuild            %9.2f ms' % rebuild)
+        print('    snapshot           %9.2f ms %9d B' % (plain, plain_size))
+        print('    snapshot, gzip     %9.2f ms %9d B' % (gzipped, gzip_size))
+        print('    snapshot, 304      %9.2f ms' % not_modified)
+        print('    snapshot, view     %9.2f ms' % view)
+    with flask_app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
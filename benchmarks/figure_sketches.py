@@ -0,0 +1,90 @@
+# Figure statistics from the sketches vs the exact scan of the stories, and the error of the estimates.
+# SQLite (a temporary file) by default, STORIES_BENCH_DB selects another database (it is emptied!).
+#
+#   python -m benchmarks.figure_sketches [stories]
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy import func
+
+from StoriesService.analytics import rebuild_sketches, figures_summary, figure_details, exact_statistics, \
+    record_story
+from StoriesService.app import create_app
+from StoriesService.database import db, Story, FigureSketch
+from StoriesService.urls import BENCH_DB, TEST_BROKER
+
+FIGURES = ['figure%d' % rank for rank in range(300)]
+WEIGHTS = [1 / (rank + 1) for rank in range(300)]
+
+
+def populate(n, authors=20000, days=365):
+    now = datetime.datetime.now()
+    rows = [{'text': 'story %d' % i, 'figures': '#%s#' % '#'.join(random.choices(FIGURES, WEIGHTS, k=6)),
+             'author_id': random.randint(1, authors), 'is_draft': False,
+             'date': now - datetime.timedelta(minutes=random.randint(0, days * 1440))} for i in range(n)]
+    for start in range(0, n, 5000):
+        db.session.execute(Story.__table__.insert(), rows[start:start + 5000])
+    db.session.commit()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    database = BENCH_DB or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'stories.db')
+    flask_app = create_app(database=database, broker=TEST_BROKER, rate_limits={})
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        populate(n)
+        start = time.perf_counter()
+        rebuild_sketches()
+        rebuild = time.perf_counter() - start
+        size = db.session.query(func.sum(func.length(FigureSketch.data))).scalar()
+
+        start = time.perf_counter()
+        counts, authors = exact_statistics()
+        exact = time.perf_counter() - start
+        start = time.perf_counter()
+        summary = figures_summary(10)
+        estimated = time.perf_counter() - start
+
+        print('%s, %d stories (%d authors)' % (db.engine.dialect.name, n, 20000))
+        print('  sketches: %d kB, rebuilt in %.1f s' % (size / 1024, rebuild))
+        print('  top 10 figures: sketches %.2f ms, exact scan %.0f ms' % (estimated * 1000, exact * 1000))
+        print('  count error bounds: figures %d, pairs %d' % (summary['error_bound'], summary['pairs_error_bound']))
+        print('  %-10s %8s %8s %8s %8s' % ('figure', 'count', 'exact', 'authors', 'exact'))
+        for item in summary['figures']:
+            print('  %-10s %8d %8d %8d %8d' % (item['figure'], item['count'], counts['figure:' + item['figure']],
+                                             item['authors'], len(authors[item['figure']])))
+
+        # Daily counts of the last 90 days and pairs, of the most used figure and of a rare one
+        end = datetime.date.today()
+        for item in (summary['figures'][0], {'figure': FIGURES[-1]}):
+            figure = item['figure']
+            details = figure_details(figure, end - datetime.timedelta(days=89), end, 10)
+            days = [end - datetime.timedelta(days=n) for n in range(90)]
+            errors = [details['days'].get(day.isoformat(), 0) - counts['day:%s:%s' % (figure, day.isoformat())]
+                      for day in days]
+            print('  %s: daily counts error mean %.2f, max %d (bound %d); with: %s (bound %d)' % (
+                figure, sum(errors) / len(errors), max(errors), details['days_error_bound'],
+                ', '.join('%s %d/%d' % (other['figure'], other['count'],
+                                        counts['pair:%s#%s' % tuple(sorted((figure, other['figure'])))])
+                          for other in details['with'][:3]) or '-', details['with_error_bound']))
+
+        # Last, as the stories are counted twice
+        stories = Story.query.limit(50).all()
+        start = time.perf_counter()
+        for story in stories:
+            record_story(story)
+            db.session.commit()
+        publish = (time.perf_counter() - start) / len(stories)
+        print('  update on publish: %.2f ms' % (publish * 1000))
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# Publish latency (POST /stories) with a slow ReactionService:
+# notification run inline (eager tasks) vs queued to Celery.
+#
+#   python -m benchmarks.publish_latency [requests] [reaction delay in ms]
+import json
+import sys
+import time
+from http.server import HTTPServer
+from threading import Thread
+from unittest.mock import patch
+
+from StoriesService.app import create_app
+from StoriesService.tasks import celery
+from StoriesService.urls import TEST_DB, TEST_BROKER
+from StoriesService.views.test.mock import MockServerRequestHandler, get_free_port
+
+
+class SlowReactionHandler(MockServerRequestHandler):
+    delay = 0.1
+
+    def do_POST(self):
+        time.sleep(self.delay)
+        super(SlowReactionHandler, self).do_POST()
+
+    def log_message(self, *args):
+        pass
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(eager, n, reactions_url):
+    flask_app = create_app(database=TEST_DB, broker=TEST_BROKER, rate_limits={})
+    # When not eager, tasks stay in the in-memory broker: no worker consumes them here
+    celery.conf.task_always_eager = eager
+    client = flask_app.test_client()
+    payload = json.dumps({'text': 'my cat is drinking a beer with my neighbour\'s dog',
+                          'figures': '#beer#cat#dog#', 'as_draft': False, 'user_id': 1})
+    latencies = []
+    with patch.dict('StoriesService.tasks.__dict__', {'NEW_REACTIONS_URL': reactions_url}):
+        for _ in range(n):
+            start = time.perf_counter()
+            response = client.post('/stories', data=payload, content_type='application/json')
+            latencies.append((time.perf_counter() - start) * 1000)
+            assert response.status_code == 201, response.data
+    return latencies
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    SlowReactionHandler.delay = (int(sys.argv[2]) if len(sys.argv) > 2 else 100) / 1000
+    port = get_free_port()
+    server = HTTPServer(('localhost', port), SlowReactionHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    reactions_url = 'http://localhost:{port}/new'.format(port=port)
+
+    print('%d publishes, ReactionService delay %d ms' % (n, SlowReactionHandler.delay * 1000))
+    for name, eager in (('inline', True), ('queued', False)):
+        latencies = run(eager, n, reactions_url)
+        print('%-7s p50 %8.2f ms   p99 %8.2f ms' % (name, percentile(latencies, 50), percentile(latencies, 99)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# Portable queries vs the dialect specific ones of the story repository.
+# SQLite (a temporary file) by default, STORIES_BENCH_DB selects another database (it is emptied!).
+#
+#   python -m benchmarks.repository [stories]
+import datetime
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from StoriesService.app import create_app
+from StoriesService.database import db, Story
+from StoriesService.repository import repository, StoryRepository
+from StoriesService.urls import BENCH_DB, TEST_BROKER
+
+
+def populate(n, authors=1000, days=60):
+    now = datetime.datetime.now()
+    rows = [{'text': 'story %d' % i, 'figures': '#cat#dog#', 'author_id': random.randint(1, authors),
+             'is_draft': random.random() < 0.1,
+             'date': now - datetime.timedelta(minutes=random.randint(0, days * 1440))} for i in range(n)]
+    for start in range(0, n, 5000):
+        db.session.execute(Story.__table__.insert(), rows[start:start + 5000])
+    db.session.commit()
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute('ANALYZE story')
+        db.session.commit()
+
+
+def timed(operation, runs=20, warmup=3):
+    for _ in range(warmup):
+        operation()
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        operation()
+        timings.append((time.perf_counter() - start) * 1000)
+        db.session.expunge_all()
+    return statistics.median(timings)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    database = BENCH_DB or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'stories.db')
+    flask_app = create_app(database=database, broker=TEST_BROKER, rate_limits={})
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        populate(n)
+        fast, portable = repository(), StoryRepository()
+        since = datetime.datetime.now() - datetime.timedelta(3)
+        everything = datetime.datetime.now() - datetime.timedelta(365)
+        print('%s, %d stories: %s vs portable' % (db.engine.dialect.name, n, type(fast).__name__))
+        for name, operation in (('latest_per_author', lambda repo: repo.latest_per_author()),
+                                ('random_recent (3 days)', lambda repo: repo.random_recent(since, 1)),
+                                ('random_recent (all)', lambda repo: repo.random_recent(everything, 1))):
+            print('  %-24s %9.2f ms %9.2f ms' % (name, timed(lambda: operation(fast)),
+                                                 timed(lambda: operation(portable))))
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# Write path overhead of the duplicate detection: POST /stories with and without it,
+# plus the latency of a replayed duplicate.
+#
+#   python -m benchmarks.write_dedup [requests]
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+from StoriesService.app import create_app
+from StoriesService.urls import TEST_BROKER
+
+
+def timed_posts(client, payloads, headers=None):
+    timings = []
+    for payload in payloads:
+        start = time.perf_counter()
+        response = client.post('/stories', data=payload, content_type='application/json', headers=headers)
+        timings.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 201, response.data
+    return timings
+
+
+def run(n, dedup_window_minutes):
+    path = os.path.join(tempfile.mkdtemp(), 'stories.db')
+    flask_app = create_app(database='sqlite:///' + path, broker=TEST_BROKER, rate_limits={},
+                           dedup_window_minutes=dedup_window_minutes)
+    client = flask_app.test_client()
+    payloads = [json.dumps({'text': 'story number %d about a cat and a dog' % i, 'figures': '#cat#dog#',
+                            'as_draft': False, 'user_id': i % 100}) for i in range(n)]
+    # Only the write path is measured, not the ReactionService notification
+    with patch('StoriesService.views.stories.story_published'):
+        writes = timed_posts(client, payloads)
+        duplicates = timed_posts(client, payloads[:n // 10], headers={'Idempotency-Key': 'retry'})
+    return writes, duplicates
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print('%d writes' % n)
+    for name, window in (('no dedup', None), ('dedup', 60)):
+        writes, duplicates = run(n, window)
+        print('%-9s write p50 %6.2f ms  p99 %6.2f ms   duplicate p50 %6.2f ms' % (
+            name, statistics.median(writes), sorted(writes)[int(len(writes) * 0.99)],
+            statistics.median(duplicates)))
+
+
+if __name__ == '__main__':
+    main()